@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Floating-point Wigner 3j, 6j, and 9j symbols.
+The arguments of wigner_3j, wigner_6j, and wigner_9j follow sympy.physics.wigner (half-integers are fine).
+Internally, everything is keyed by doubled spins and memoized.
+The 3j and 6j sums are done exactly, the 6j prefactor comes from a log-gamma table sized by set_jmax.
+"""
+import math
+from fractions import Fraction
+from functools import lru_cache
+import numpy as np
+
+_jmax = 0
+_log_factorials = np.zeros(1)
+
+def set_jmax(jmax, cache_size=None):
+    """
+    jmax: the largest angular momentum (not doubled) expected in the symbols
+    cache_size: maxsize of the LRU caches (None means unbounded)
+    """
+    global _jmax
+    global wigner_3j_doubled, wigner_6j_doubled, wigner_9j_doubled
+    _jmax = jmax
+    _set_log_factorials( int(4*jmax) + 2 )
+    wigner_3j_doubled = lru_cache(maxsize=cache_size)( wigner_3j_doubled.__wrapped__ )
+    wigner_6j_doubled = lru_cache(maxsize=cache_size)( wigner_6j_doubled.__wrapped__ )
+    wigner_9j_doubled = lru_cache(maxsize=cache_size)( wigner_9j_doubled.__wrapped__ )
+
+def _set_log_factorials(nmax):
+    global _log_factorials
+    _log_factorials = np.array( [ math.lgamma(n+1) for n in range(nmax+1) ] )
+
+def _log_fact(n):
+    if( n >= len(_log_factorials) ): _set_log_factorials( 2*n )
+    return _log_factorials[n]
+
+def _doubled(j):
+    return int(round(2*j))
+
+def _triag(j1, j2, j3):
+    """
+    True if doubled spins j1, j2, j3 can NOT be coupled
+    """
+    if( (j1+j2+j3)%2 == 1 ): return True
+    if( abs(j1-j2) <= j3 <= j1+j2 ): return False
+    return True
+
+def _log_delta(j1, j2, j3):
+    return 0.5 * ( _log_fact((j1+j2-j3)//2) + _log_fact((j1-j2+j3)//2) + \
+            _log_fact((-j1+j2+j3)//2) - _log_fact((j1+j2+j3)//2+1) )
+
+@lru_cache(maxsize=None)
+def wigner_3j_doubled(j1, j2, j3, m1, m2, m3):
+    """
+    3j symbol, all the arguments are doubled
+    """
+    if( m1+m2+m3 != 0 ): return 0.0
+    if( _triag(j1, j2, j3) ): return 0.0
+    if( abs(m1) > j1 or abs(m2) > j2 or abs(m3) > j3 ): return 0.0
+    if( (j1+m1)%2 == 1 or (j2+m2)%2 == 1 or (j3+m3)%2 == 1 ): return 0.0
+    k1 = (j3-j2+m1)//2
+    k2 = (j3-j1-m2)//2
+    n1 = (j1+j2-j3)//2
+    n2 = (j1-m1)//2
+    n3 = (j2+m2)//2
+    kmin = max(0, -k1, -k2)
+    kmax = min(n1, n2, n3)
+    # the Racah sum and the square of its prefactor are rational, so both are done exactly
+    f = math.factorial
+    s = Fraction(0)
+    for k in range(kmin, kmax+1):
+        s += Fraction( (-1)**k, f(k) * f(k1+k) * f(k2+k) * f(n1-k) * f(n2-k) * f(n3-k) )
+    if( s == 0 ): return 0.0
+    x = Fraction( f(n1) * f((j1-j2+j3)//2) * f((-j1+j2+j3)//2), f((j1+j2+j3)//2+1) ) * \
+            f((j1+m1)//2) * f((j1-m1)//2) * f((j2+m2)//2) * f((j2-m2)//2) * f((j3+m3)//2) * f((j3-m3)//2) * s * s
+    r = math.exp( 0.5 * ( math.log(x.numerator) - math.log(x.denominator) ) )
+    return math.copysign( r, s ) * (-1)**((j1-j2-m3)//2)
+
+@lru_cache(maxsize=None)
+def wigner_6j_doubled(j1, j2, j3, j4, j5, j6):
+    """
+    6j symbol {j1 j2 j3; j4 j5 j6}, all the arguments are doubled
+    """
+    if( _triag(j1, j2, j3) ): return 0.0
+    if( _triag(j1, j5, j6) ): return 0.0
+    if( _triag(j4, j2, j6) ): return 0.0
+    if( _triag(j4, j5, j3) ): return 0.0
+    a1 = (j1+j2+j3)//2
+    a2 = (j1+j5+j6)//2
+    a3 = (j4+j2+j6)//2
+    a4 = (j4+j5+j3)//2
+    b1 = (j1+j2+j4+j5)//2
+    b2 = (j2+j3+j5+j6)//2
+    b3 = (j3+j1+j6+j4)//2
+    lnorm = _log_delta(j1, j2, j3) + _log_delta(j1, j5, j6) + \
+            _log_delta(j4, j2, j6) + _log_delta(j4, j5, j3)
+    # each term of the Racah sum is an integer, so the alternating sum is done exactly
+    s = 0
+    for t in range(max(a1, a2, a3, a4), min(b1, b2, b3)+1):
+        s += (-1)**t * math.factorial(t+1) // ( \
+                math.factorial(t-a1) * math.factorial(t-a2) * math.factorial(t-a3) * math.factorial(t-a4) * \
+                math.factorial(b1-t) * math.factorial(b2-t) * math.factorial(b3-t) )
+    if( s == 0 ): return 0.0
+    return math.copysign( math.exp( math.log(abs(s)) + lnorm ), s )
+
+@lru_cache(maxsize=None)
+def wigner_9j_doubled(j1, j2, j3, j4, j5, j6, j7, j8, j9):
+    """
+    9j symbol {j1 j2 j3; j4 j5 j6; j7 j8 j9}, all the arguments are doubled
+    """
+    if( _triag(j1, j2, j3) ): return 0.0
+    if( _triag(j4, j5, j6) ): return 0.0
+    if( _triag(j7, j8, j9) ): return 0.0
+    if( _triag(j1, j4, j7) ): return 0.0
+    if( _triag(j2, j5, j8) ): return 0.0
+    if( _triag(j3, j6, j9) ): return 0.0
+    xmin = max(abs(j1-j9), abs(j4-j8), abs(j2-j6))
+    xmax = min(j1+j9, j4+j8, j2+j6)
+    s = 0.0
+    for x in range(xmin, xmax+1, 2):
+        s += (-1)**x * (x+1) * wigner_6j_doubled(j1, j4, j7, j8, j9, x) * \
+                wigner_6j_doubled(j2, j5, j8, j4, x, j6) * wigner_6j_doubled(j3, j6, j9, x, j1, j2)
+    return s
+
+def wigner_3j(j1, j2, j3, m1, m2, m3):
+    return wigner_3j_doubled( _doubled(j1), _doubled(j2), _doubled(j3), _doubled(m1), _doubled(m2), _doubled(m3) )
+
+def wigner_6j(j1, j2, j3, j4, j5, j6):
+    return wigner_6j_doubled( _doubled(j1), _doubled(j2), _doubled(j3), _doubled(j4), _doubled(j5), _doubled(j6) )
+
+def wigner_9j(j1, j2, j3, j4, j5, j6, j7, j8, j9):
+    return wigner_9j_doubled( _doubled(j1), _doubled(j2), _doubled(j3), _doubled(j4), _doubled(j5), _doubled(j6), \
+            _doubled(j7), _doubled(j8), _doubled(j9) )
+
+set_jmax(20)
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import copy
+import os, sys, copy, pickle, hashlib, weakref
 if(__package__==None or __package__==""):
     import Orbits, OrbitsIsospin
     import TwoBodySpace
@@ -10,6 +10,14 @@ else:
     from . import ThreeBodySpace
 
 class ModelSpace:
+    """
+    Operators and densities keep a reference to their ModelSpace (no copy), so a ModelSpace
+    must not be modified once it is set. get_modelspace returns one shared instance per space.
+    """
+    _registry = weakref.WeakValueDictionary()
+    cache_dir = None
+    # bump when the pickled classes (ModelSpace, Orbits, TwoBodySpace, ...) change, so that old caches are not loaded
+    _cache_version = 2
     def __init__(self, rank=2):
         self.orbits = None
         self.iorbits = None
@@ -43,6 +51,51 @@ class ModelSpace:
         if(self.rank>=2): self.two = TwoBodySpace.TwoBodySpace( orbits=self.orbits, e2max=e2max )
         if(self.rank>=3 and iorbits!=None): self.iorbits = copy.deepcopy(iorbits)
         if(self.rank>=3 and iorbits!=None): self.three = ThreeBodySpace.ThreeBodySpace( orbits=self.iorbits, e2max=e2max, e3max=e3max )
+    @classmethod
+    def get_modelspace(cls, orbits=None, emax=None, e2max=None, e3max=None, iorbits=None, rank=2):
+        """
+        shared ModelSpace built from orbits (as set_modelspace_from_orbits) or from emax
+        (as set_modelspace_from_boundaries). The same space is built only once as long as it is in use,
+        and the returned instance has to be treated as read-only. A space from emax and the same space
+        from its orbits are the same instance. If ModelSpace.cache_dir is set (see set_cache_dir),
+        the spaces are also pickled there and reused by later runs.
+        """
+        if( orbits is None and emax is None ):
+            print("Either orbits or emax is needed in " + sys._getframe().f_code.co_name )
+            return None
+        if( orbits is None ):
+            orbits = Orbits( emax=emax )
+            if( rank >= 3 and iorbits is None ): iorbits = OrbitsIsospin( emax=emax )
+        if( rank < 3 ): iorbits = None
+        e2max_key = -1 if rank==1 else ( 2*orbits.emax if e2max is None else e2max )
+        e3max_key = -1 if rank==1 else ( 3*orbits.emax if e3max is None else e3max )
+        key = ( rank, e2max_key, e3max_key, tuple( o.get_nljz() for o in orbits.orbits ), \
+                None if iorbits is None else tuple( o.get_nlj() for o in iorbits.orbits ) )
+        ms = cls._registry.get( key )
+        if( ms is not None ): return ms
+        fn = None
+        if( cls.cache_dir is not None ):
+            fn = os.path.join( cls.cache_dir, "modelspace_" + hashlib.sha1( repr( (cls._cache_version,)+key ).encode() ).hexdigest() + ".pkl" )
+        if( fn is not None and os.path.exists(fn) ):
+            with open(fn, "rb") as f: ms = pickle.load(f)
+        else:
+            ms = cls(rank=rank)
+            ms.set_modelspace_from_orbits( orbits, e2max=e2max, e3max=e3max, iorbits=iorbits )
+            if( fn is not None ):
+                with open(fn+".tmp", "wb") as f: pickle.dump( ms, f, protocol=pickle.HIGHEST_PROTOCOL )
+                os.replace( fn+".tmp", fn )
+        cls._registry[key] = ms
+        return ms
+    @classmethod
+    def set_cache_dir(cls, cache_dir):
+        """
+        directory for the pickled model spaces of get_modelspace (None to disable)
+        """
+        if( cache_dir is not None and not os.path.exists(cache_dir) ): os.makedirs( cache_dir )
+        cls.cache_dir = cache_dir
+    @classmethod
+    def clear_registry(cls):
+        cls._registry = weakref.WeakValueDictionary()
     def print_modelspace_summary(self):
         self.orbits.print_orbits()
         if(self.rank>=2): self.two.print_channels()
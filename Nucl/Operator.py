@@ -1,41 +1,191 @@
 #!/usr/bin/env python3
 import sys, subprocess
 import numpy as np
-import copy
+import os
 import gzip
-from sympy import N
-from sympy.physics.wigner import wigner_6j, wigner_9j
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import json
+import collections
 if(__package__==None or __package__==""):
     import ModelSpace
     import nushell2snt
+    from AngularMomentum import wigner_6j, wigner_9j
 else:
     from . import Orbits, OrbitsIsospin
     from . import ModelSpace
     from . import nushell2snt
+    from .AngularMomentum import wigner_6j, wigner_9j
+
+def _me2j_one_indices(iorbits, rankJ, rankP):
+    """
+    isospin-orbit indices (i, j) of the one-body lines in the line order of the .op.me2j format
+    """
+    norbs = iorbits.get_num_orbits()
+    l, j = iorbits.l[1:], iorbits.j[1:]
+    ii, jj = np.meshgrid( np.arange(norbs), np.arange(norbs), indexing="ij" )
+    mask = ( (-1)**(l[ii]+l[jj]) * rankP == 1 ) & ( np.abs(j[ii]-j[jj]) <= 2*rankJ ) & ( 2*rankJ <= j[ii]+j[jj] )
+    return ii[mask]+1, jj[mask]+1
+
+def _iter_me2j_two_indices(iorbits, e2max, rankJ, rankP, nlines=1<<20):
+    """
+    isospin-orbit indices (i, j, k, l, Jij, Jkl) of the two-body lines in the line order of the .op.me2j format,
+    yielded in chunks of about nlines lines (a chunk always ends at an (ij) pair)
+    """
+    norbs = iorbits.get_num_orbits()
+    l, j, e = iorbits.l[1:], iorbits.j[1:], iorbits.e[1:]
+    pairs = [ (i, k) for i in range(norbs) for k in range(i+1) if e[i]+e[k] <= e2max ]
+    p1 = np.array( [ p[0] for p in pairs ], dtype=int )
+    p2 = np.array( [ p[1] for p in pairs ], dtype=int )
+    Jmin = np.abs( j[p1]-j[p2] )//2
+    nJ = ( j[p1]+j[p2] )//2 - Jmin + 1
+    NJ = nJ.max() if len(pairs) else 0
+    dJ = np.arange(NJ)
+    parity = l[p1]+l[p2]
+    out = [ [] for x in range(6) ]
+    n = 0
+    for ip in range(len(pairs)):
+        kls = np.nonzero( (-1)**(parity[ip]+parity) * rankP == 1 )[0]
+        Jij = Jmin[ip] + dJ[:,None,None]
+        Jkl = Jmin[kls][None,None,:] + dJ[None,:,None]
+        valid = ( dJ[:,None,None] < nJ[ip] ) & ( dJ[None,:,None] < nJ[kls][None,None,:] )
+        valid &= ( np.abs(Jij-Jkl) <= rankJ ) & ( rankJ <= Jij+Jkl )
+        valid = valid.transpose(2,0,1) # (kl, Jij, Jkl) in the line order
+        ikl, iJij, iJkl = np.nonzero( valid )
+        out[0].append( np.full( len(ikl), p1[ip]+1 ) )
+        out[1].append( np.full( len(ikl), p2[ip]+1 ) )
+        out[2].append( p1[kls][ikl]+1 )
+        out[3].append( p2[kls][ikl]+1 )
+        out[4].append( Jmin[ip] + iJij )
+        out[5].append( Jmin[kls][ikl] + iJkl )
+        n += len(ikl)
+        if( n >= nlines or ip == len(pairs)-1 ):
+            yield tuple( np.concatenate(x).astype(int) for x in out )
+            out = [ [] for x in range(6) ]
+            n = 0
+
+class _NumberStream:
+    """
+    whitespace-separated numbers of f (text or binary mode), parsed chunk by chunk
+    """
+    def __init__(self, f, chunk_size=1<<26):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = np.zeros(0)
+        self.rest = ""
+        self.eof = False
+    def _fill(self):
+        if( self.eof ): return False
+        chunk = self.f.read(self.chunk_size)
+        if( isinstance(chunk, bytes) ): chunk = chunk.decode()
+        if( len(chunk) == 0 ):
+            self.eof = True
+            text, self.rest = self.rest, ""
+        else:
+            chunk = self.rest + chunk
+            cut = max( chunk.rfind("\n"), chunk.rfind(" ") )
+            if( cut == -1 ):
+                self.rest = chunk
+                return True
+            text, self.rest = chunk[:cut], chunk[cut:]
+        self.buffer = np.concatenate( ( self.buffer, np.array( text.split(), dtype=float ) ) )
+        return True
+    def take(self, n):
+        """
+        next n numbers (fewer only at the end of the file)
+        """
+        while len(self.buffer) < n and self._fill(): pass
+        out, self.buffer = self.buffer[:n], self.buffer[n:]
+        return out
+
+class _LazyChannelBlocks:
+    """
+    read-only mapping (ichbra, ichket) -> two-body block of a binary (.opbin) operator file,
+    a block is decoded from the file when it is first accessed and
+    at most max_channels blocks are kept in memory (least recently used ones are dropped)
+    """
+    def __init__(self, filename, data_offset, blocks, max_channels=None):
+        self.filename = filename
+        self.max_channels = max_channels
+        self.blocks = collections.OrderedDict()
+        for ichbra, ichket, nbra, nket, offset in blocks:
+            self.blocks[(ichbra,ichket)] = (nbra, nket, offset)
+        self.resident = collections.OrderedDict()
+        self.data = np.memmap( filename, dtype="<f8", mode="r", offset=data_offset )
+    def __getitem__(self, key):
+        if( key in self.resident ):
+            self.resident.move_to_end( key )
+            return self.resident[key]
+        nbra, nket, offset = self.blocks[key]
+        block = np.array( self.data[offset:offset+nbra*nket] ).reshape( nbra, nket )
+        block.flags.writeable = False
+        self.resident[key] = block
+        if( self.max_channels is not None and len(self.resident) > self.max_channels ):
+            self.resident.popitem( last=False )
+        return block
+    def __contains__(self, key):
+        return key in self.blocks
+    def __iter__(self):
+        return iter( self.blocks )
+    def __len__(self):
+        return len( self.blocks )
+    def keys(self):
+        return self.blocks.keys()
+    def values(self):
+        for key in self.blocks: yield self[key]
+    def items(self):
+        for key in self.blocks: yield key, self[key]
+    def get_number_resident_channels(self):
+        return len( self.resident )
+
+def _format_rows(fmt, rows):
+    """
+    format a 2D array row by row with fmt in one string operation
+    """
+    if( len(rows) == 0 ): return ""
+    return ( (fmt+"\n") * len(rows) ) % tuple( np.asarray(rows).ravel().tolist() )
 
 def _ls_coupling(la, ja, lb, jb, Lab, Sab, J):
     return np.sqrt( (2*ja+1)*(2*jb+1)*(2*Lab+1)*(2*Sab+1) ) * \
-            N( wigner_9j( la, 0.5, ja, lb, 0.5, jb, Lab, Sab, J) )
+            wigner_9j( la, 0.5, ja, lb, 0.5, jb, Lab, Sab, J)
 
 
 class Operator:
-    def __init__(self, rankJ=0, rankP=1, rankZ=0, ms=None, reduced=False, filename=None, verbose=False):
+    def __init__(self, rankJ=0, rankP=1, rankZ=0, ms=None, reduced=False, filename=None, verbose=False, dense=False, mmap=False,
+            lazy=False, max_channels=None):
+        """
+        dense: if True, each two-body channel pair is stored as a float64 matrix
+               instead of a dict keyed by (bra, ket)
+        mmap: if True, a binary (.opbin) file is memory-mapped instead of read into memory
+        lazy: if True, two-body channel blocks are decoded only when they are accessed (read-only),
+              see read_operator_file
+        max_channels: the maximum number of decoded channel blocks kept in memory in the lazy mode
+        """
         self.ms = ms
         self.rankJ = rankJ
         self.rankP = rankP
         self.rankZ = rankZ
         self.reduced = reduced
         self.verbose = verbose
+        self.dense = dense
         self.zero = 0.0
         self.one = None
         self.two = {}
         self.three = {}
+        self._binary_target = None
         if( rankJ != 0 ): self.reduced = True
         if( ms != None ): self.allocate_operator( ms )
-        if( filename != None ): self.read_operator_file( filename )
+        if( filename != None ): self.read_operator_file( filename, mmap=mmap, lazy=lazy, max_channels=max_channels )
 
     def allocate_operator(self, ms):
-        self.ms = copy.deepcopy(ms)
+        """
+        ms is shared, not copied
+        """
+        self._allocate_storage( ms )
+        if( self._binary_target is not None ): self._map_binary_storage( self._binary_target )
+    def _allocate_storage(self, ms):
+        self.ms = ms
         self.zero = 0.0
         self.one = np.zeros( (ms.orbits.get_num_orbits(), ms.orbits.get_num_orbits() ))
         if(self.ms.rank==1): return
@@ -47,7 +197,10 @@ class Operator:
                 if( self._triag( chbra.J, chket.J, self.rankJ )): continue
                 if( chbra.P * chket.P * self.rankP != 1): continue
                 if( abs(chbra.Z-chket.Z) != self.rankZ): continue
-                self.two[(ichbra,ichket)] = {}
+                if( self.dense ):
+                    self.two[(ichbra,ichket)] = np.zeros( (chbra.get_number_states(), chket.get_number_states()) )
+                else:
+                    self.two[(ichbra,ichket)] = {}
         if(self.ms.rank==2): return
         three = ms.three
         for ichbra in range(ms.three.get_number_channels()):
@@ -59,12 +212,7 @@ class Operator:
                 if( self._triag( chbra.T, chket.T, 2*self.rankZ )): continue
                 self.three[(ichbra,ichket)] = {}
     def count_nonzero_1bme(self):
-        counter = 0
-        norbs = self.ms.orbits.get_num_orbits()
-        for i in range(norbs):
-            for j in range(norbs):
-                if( abs( self.one[i,j] ) > 1.e-10 ): counter += 1
-        return counter
+        return int( np.count_nonzero( np.abs( self.one ) > 1.e-10 ) )
     def count_nonzero_2bme(self):
         counter = 0
         two = self.ms.two
@@ -76,7 +224,8 @@ class Operator:
                 if( self._triag( chbra.J, chket.J, self.rankJ )): continue
                 if( chbra.P * chket.P * self.rankP != 1): continue
                 if( abs(chbra.Z-chket.Z) != self.rankZ): continue
-                counter += len( self.two[(i,j)] )
+                if( self.dense ): counter += np.count_nonzero( self.two[(i,j)] )
+                else: counter += len( self.two[(i,j)] )
         return counter
     def count_nonzero_3bme(self):
         counter = 0
@@ -108,50 +257,72 @@ class Operator:
             return
         self.one[a-1,b-1] = me
         self.one[b-1,a-1] = me * (-1)**( (ob.j-oa.j)//2 )
+    def set_1bme_batch( self, a, b, me ):
+        """
+        vectorized version of set_1bme, forbidden entries are skipped
+        """
+        a = np.asarray(a, dtype=int).ravel()
+        b = np.asarray(b, dtype=int).ravel()
+        me = np.asarray(me, dtype=float).ravel()
+        orbits = self.ms.orbits
+        j = orbits.j
+        ok = orbits.get_pair_mask( self.rankJ, self.rankP, self.rankZ )[a,b]
+        a, b, me = a[ok], b[ok], me[ok]
+        # interleaved so that the later entries win as in set_1bme
+        rows = np.column_stack( (a-1, b-1) ).ravel()
+        cols = np.column_stack( (b-1, a-1) ).ravel()
+        self.one[rows,cols] = np.column_stack( (me, me * (1-2*(((j[b]-j[a])//2)%2))) ).ravel()
     def set_2bme_from_mat_indices( self, chbra, chket, bra, ket, me ):
         if( chbra < chket ):
             if(self.verbose): print("Warning:" + sys._getframe().f_code.co_name )
             return
         self.two[(chbra,chket)][(bra,ket)] = me
         if( chbra == chket ): self.two[(chbra,chket)][ket,bra] = me
-    def set_2bme_from_indices( self, a, b, c, d, Jab, Jcd, me ):
-        two = self.ms.two
-        orbits = two.orbits
-        oa = orbits.get_orbit(a)
-        ob = orbits.get_orbit(b)
-        oc = orbits.get_orbit(c)
-        od = orbits.get_orbit(d)
-        Pab = (-1)**(oa.l+ob.l)
-        Pcd = (-1)**(oc.l+od.l)
-        Zab = (oa.z + ob.z)//2
-        Zcd = (oc.z + od.z)//2
-        if( self._triag( Jab, Jcd, self.rankJ )):
-            if(self.verbose): print("Warning: J, " + sys._getframe().f_code.co_name )
-            return
-        if( Pab * Pcd * self.rankP != 1):
-            if(self.verbose): print("Warning: Parity, " + sys._getframe().f_code.co_name )
+    def set_2bme_block( self, chbra, chket, mat, mask=None ):
+        """
+        overwrite the channel pair (chbra,chket) with the dense matrix mat
+        mask: only the entries with True are written
+        """
+        if( chbra < chket ):
+            if(self.verbose): print("Warning:" + sys._getframe().f_code.co_name )
             return
-        if( abs(Zab-Zcd) != self.rankZ):
-            if(self.verbose): print("Warning: Z, " + sys._getframe().f_code.co_name )
+        block = self.two[(chbra,chket)]
+        if( self.dense ):
+            if( mask is None ): block[:,:] = mat
+            else: block[mask] = mat[mask]
             return
-        ichbra_tmp = two.get_index(Jab,Pab,Zab)
-        ichket_tmp = two.get_index(Jcd,Pcd,Zcd)
-        phase = 1
-        if( ichbra_tmp >= ichket_tmp ):
-            ichbra = ichbra_tmp
-            ichket = ichket_tmp
-            aa, bb, cc, dd, = a, b, c, d
-        else:
-            ichbra = ichket_tmp
-            ichket = ichbra_tmp
-            phase *=  (-1)**(Jcd-Jab)
-            aa, bb, cc, dd, = c, d, a, b
-        chbra = two.get_channel(ichbra)
-        chket = two.get_channel(ichket)
-        bra = chbra.index_from_indices[(aa,bb)]
-        ket = chket.index_from_indices[(cc,dd)]
-        phase *= chbra.phase_from_indices[(aa,bb)] * chket.phase_from_indices[(cc,dd)]
+        if( mask is None ): mask = mat != 0.0
+        bras, kets = np.nonzero( mask )
+        for bra, ket, me in zip( bras.tolist(), kets.tolist(), mat[bras,kets].tolist() ):
+            block[(bra,ket)] = me
+    def set_2bme_from_indices( self, a, b, c, d, Jab, Jcd, me ):
+        ichbra, ichket, bra, ket, phase = self._resolve_2bme_index( a, b, c, d, Jab, Jcd )
+        if( ichbra < 0 ): return
         self.set_2bme_from_mat_indices(ichbra,ichket,bra,ket,me*phase)
+    def _resolve_2bme_index( self, a, b, c, d, Jab, Jcd ):
+        """
+        scalar (a, b, c, d, Jab, Jcd) -> (chbra, chket, bra, ket, phase) with chbra >= chket,
+        chbra is -1 for the forbidden entries
+        """
+        if( self._triag( Jab, Jcd, self.rankJ )):
+            if(self.verbose): print("Warning: J, " + sys._getframe(1).f_code.co_name )
+            return -1, -1, -1, -1, 0
+        two = self.ms.two
+        ich_ab, idx_ab, ph_ab = two.lookup( a, b, Jab )
+        ich_cd, idx_cd, ph_cd = two.lookup( c, d, Jcd )
+        if( ich_ab < 0 or ich_cd < 0 ):
+            if(self.verbose): print("Warning: bra & ket index, " + sys._getframe(1).f_code.co_name )
+            return -1, -1, -1, -1, 0
+        chab = two.channels[ich_ab]
+        chcd = two.channels[ich_cd]
+        if( chab.P * chcd.P * self.rankP != 1):
+            if(self.verbose): print("Warning: Parity, " + sys._getframe(1).f_code.co_name )
+            return -1, -1, -1, -1, 0
+        if( abs(chab.Z-chcd.Z) != self.rankZ):
+            if(self.verbose): print("Warning: Z, " + sys._getframe(1).f_code.co_name )
+            return -1, -1, -1, -1, 0
+        if( ich_ab >= ich_cd ): return ich_ab, ich_cd, idx_ab, idx_cd, ph_ab*ph_cd
+        return ich_cd, ich_ab, idx_cd, idx_ab, ph_ab*ph_cd*(-1)**(Jcd-Jab)
     def set_2bme_from_orbits( self, oa, ob, oc, od, Jab, Jcd, me ):
         orbits = self.ms.orbits
         a = orbits.orbit_index_from_orbit( oa )
@@ -235,62 +406,115 @@ class Operator:
         return self.zero
     def get_1bme(self,a,b):
         return self.one[a-1,b-1]
+    def get_2bme_items(self,chbra,chket):
+        """
+        returns a list of ((bra,ket), me) stored in the channel pair (chbra,chket)
+        In the dense storage, only non-zero entries are returned.
+        """
+        block = self.two[(chbra,chket)]
+        if( not self.dense ): return list( block.items() )
+        bras, kets = np.nonzero( block )
+        return [ ((bra,ket),me) for bra, ket, me in zip( bras.tolist(), kets.tolist(), block[bras,kets].tolist() ) ]
+    def get_2bme_block(self,chbra,chket):
+        """
+        returns the channel pair (chbra,chket) as a dense matrix (a copy for the dict storage)
+        """
+        block = self.two[(chbra,chket)]
+        if( self.dense ): return block.copy()
+        two = self.ms.two
+        mat = np.zeros( (two.get_channel(chbra).get_number_states(), two.get_channel(chket).get_number_states()) )
+        for (bra,ket), me in block.items(): mat[bra,ket] = me
+        return mat
     def get_2bme_from_mat_indices(self,chbra,chket,bra,ket):
         if( chbra < chket ):
             if(self.verbose): print("Warning:" + sys._getframe().f_code.co_name )
             return 0
-        try:
-            return self.two[(chbra,chket)][(bra,ket)]
-        except:
+        if( (chbra,chket) not in self.two ):
             if(self.verbose): print("Nothing here " + sys._getframe().f_code.co_name )
             return 0
+        if( self.dense ): return self.two[(chbra,chket)][bra,ket]
+        return self.two[(chbra,chket)].get( (bra,ket), 0 )
     def get_2bme_from_indices( self, a, b, c, d, Jab, Jcd ):
         if(self.ms.rank <= 1): return 0
-        two = self.ms.two
-        orbits = two.orbits
-        oa = orbits.get_orbit(a)
-        ob = orbits.get_orbit(b)
-        oc = orbits.get_orbit(c)
-        od = orbits.get_orbit(d)
-        Pab = (-1)**(oa.l+ob.l)
-        Pcd = (-1)**(oc.l+od.l)
-        Zab = (oa.z + ob.z)//2
-        Zcd = (oc.z + od.z)//2
-        if( self._triag( Jab, Jcd, self.rankJ )):
-            if(self.verbose): print("Warning: J, " + sys._getframe().f_code.co_name )
-            return 0
-        if( Pab * Pcd * self.rankP != 1):
-            if(self.verbose): print("Warning: Parity, " + sys._getframe().f_code.co_name )
-            return 0
-        if( abs(Zab-Zcd) != self.rankZ):
-            if(self.verbose): print("Warning: Z, " + sys._getframe().f_code.co_name )
-            return 0
-        try:
-            ichbra_tmp = two.get_index(Jab,Pab,Zab)
-            ichket_tmp = two.get_index(Jcd,Pcd,Zcd)
-        except:
-            if(self.verbose): print("Warning: channel bra & ket index, " + sys._getframe().f_code.co_name )
-            return 0
-        phase = 1
-        if( ichbra_tmp >= ichket_tmp ):
-            ichbra = ichbra_tmp
-            ichket = ichket_tmp
-            aa, bb, cc, dd, = a, b, c, d
-        else:
-            ichbra = ichket_tmp
-            ichket = ichbra_tmp
-            phase *=  (-1)**(Jcd-Jab)
-            aa, bb, cc, dd, = c, d, a, b
-        chbra = two.get_channel(ichbra)
-        chket = two.get_channel(ichket)
-        try:
-            bra = chbra.index_from_indices[(aa,bb)]
-            ket = chket.index_from_indices[(cc,dd)]
-        except:
-            if(self.verbose): print("Warning: bra & ket index, " + sys._getframe().f_code.co_name )
-            return 0
-        phase *= chbra.phase_from_indices[(aa,bb)] * chket.phase_from_indices[(cc,dd)]
+        ichbra, ichket, bra, ket, phase = self._resolve_2bme_index( a, b, c, d, Jab, Jcd )
+        if( ichbra < 0 ): return 0
         return self.get_2bme_from_mat_indices(ichbra,ichket,bra,ket)*phase
+    def _resolve_2bme_indices( self, a, b, c, d, Jab, Jcd ):
+        """
+        vectorized (a, b, c, d, Jab, Jcd) -> (chbra, chket, bra, ket, phase) with chbra >= chket
+        output:
+            ok: mask of the allowed entries, the other arrays are already restricted to ok
+        """
+        two = self.ms.two
+        ich_ab, idx_ab, ph_ab = two.lookup_from_indices( a, b, Jab )
+        ich_cd, idx_cd, ph_cd = two.lookup_from_indices( c, d, Jcd )
+        JPZ = two.JPZ_from_index
+        ok = (ich_ab >= 0) & (ich_cd >= 0)
+        ok &= (np.abs(Jab-Jcd) <= self.rankJ) & (self.rankJ <= Jab+Jcd)
+        ok &= JPZ[ich_ab,1] * JPZ[ich_cd,1] * self.rankP == 1
+        ok &= np.abs(JPZ[ich_ab,2] - JPZ[ich_cd,2]) == self.rankZ
+        flip = ich_ab < ich_cd
+        ichbra = np.where(flip, ich_cd, ich_ab)[ok]
+        ichket = np.where(flip, ich_ab, ich_cd)[ok]
+        bra = np.where(flip, idx_cd, idx_ab)[ok]
+        ket = np.where(flip, idx_ab, idx_cd)[ok]
+        phase = ph_ab * ph_cd * np.where(flip, 1-2*(np.abs(Jcd-Jab)%2), 1)
+        return ok, ichbra, ichket, bra, ket, phase[ok]
+    def _channel_pair_groups( self, ichbra, ichket ):
+        """
+        yields ((chbra,chket), mask) for each channel pair appearing in the arrays
+        """
+        nch = self.ms.two.get_number_channels()
+        keys = ichbra * nch + ichket
+        if( len(keys) == 0 ): return
+        order = np.argsort( keys, kind="stable" )
+        uniq, starts = np.unique( keys[order], return_index=True )
+        ends = np.append( starts[1:], len(keys) )
+        for key, start, end in zip( uniq.tolist(), starts.tolist(), ends.tolist() ):
+            yield (key//nch, key%nch), order[start:end]
+    def get_2bme_batch( self, a, b, c, d, Jab, Jcd ):
+        """
+        vectorized version of get_2bme_from_indices
+        inputs:
+            a, b, c, d, Jab, Jcd: integer arrays with the same length
+        output:
+            float array of the matrix elements, 0 for the forbidden ones
+        """
+        a, b, c, d, Jab, Jcd = [ np.asarray(x, dtype=int).ravel() for x in (a, b, c, d, Jab, Jcd) ]
+        mes = np.zeros( len(a) )
+        if(self.ms.rank <= 1 or len(a)==0): return mes
+        ok, ichbra, ichket, bra, ket, phase = self._resolve_2bme_indices( a, b, c, d, Jab, Jcd )
+        vals = np.zeros( len(bra) )
+        for key, idx in self._channel_pair_groups( ichbra, ichket ):
+            block = self.two[key]
+            if( self.dense ):
+                vals[idx] = block[bra[idx],ket[idx]]
+            else:
+                vals[idx] = [ block.get((i,j), 0.0) for i, j in zip(bra[idx].tolist(), ket[idx].tolist()) ]
+        mes[ok] = vals * phase
+        return mes
+    def set_2bme_batch( self, a, b, c, d, Jab, Jcd, me ):
+        """
+        vectorized version of set_2bme_from_indices, forbidden entries are skipped
+        """
+        a, b, c, d, Jab, Jcd = [ np.asarray(x, dtype=int).ravel() for x in (a, b, c, d, Jab, Jcd) ]
+        me = np.asarray(me, dtype=float).ravel()
+        if(self.ms.rank <= 1 or len(a)==0): return
+        ok, ichbra, ichket, bra, ket, phase = self._resolve_2bme_indices( a, b, c, d, Jab, Jcd )
+        vals = me[ok] * phase
+        for (chbra, chket), idx in self._channel_pair_groups( ichbra, ichket ):
+            block = self.two[(chbra,chket)]
+            if( self.dense and chbra != chket ):
+                block[bra[idx],ket[idx]] = vals[idx]
+            elif( self.dense ):
+                # interleaved so that the later entries win as in the element-wise setter
+                rows = np.column_stack( (bra[idx], ket[idx]) ).ravel()
+                cols = np.column_stack( (ket[idx], bra[idx]) ).ravel()
+                block[rows,cols] = np.repeat( vals[idx], 2 )
+            else:
+                for i, j, v in zip( bra[idx].tolist(), ket[idx].tolist(), vals[idx].tolist() ):
+                    block[(i,j)] = v
+                    if( chbra == chket ): block[(j,i)] = v
     def get_2bme_from_orbits( self, oa, ob, oc, od, Jab, Jcd ):
         if(self.ms.rank <= 1): return 0
         orbits = self.ms.orbits
@@ -347,7 +571,142 @@ class Operator:
         ket = chket.index_from_indices[(l,m,n,Jlm,Tlm)]
         return self.set_3bme_from_mat_indices(ichbra,ichket,bra,ket) * phase
 
-    def read_operator_file(self, filename, spfile=None, opfile2=None, comment="!", istore=None, A=None):
+    def _empty_like(self):
+        """
+        returns a zero operator with the same ranks and storage, sharing the model space
+        """
+        op = Operator( rankJ=self.rankJ, rankP=self.rankP, rankZ=self.rankZ, reduced=self.reduced, verbose=self.verbose, dense=self.dense )
+        op.ms = self.ms
+        if( self.one is not None ): op.one = np.zeros_like( self.one )
+        for key, block in self.two.items():
+            if( self.dense ): op.two[key] = np.zeros_like( block )
+            else: op.two[key] = {}
+        for key in self.three.keys():
+            op.three[key] = {}
+        return op
+    def copy(self):
+        """
+        returns a copy of the matrix elements, sharing the model space
+        """
+        op = self._empty_like()
+        op.axpy( 1.0, self )
+        return op
+    def _check_compatible(self, other):
+        if( (self.rankJ, self.rankP, self.rankZ) != (other.rankJ, other.rankP, other.rankZ) ):
+            raise ValueError("Operators with different ranks cannot be combined in " + sys._getframe(1).f_code.co_name)
+        self._check_same_modelspace( other, sys._getframe(1).f_code.co_name )
+    def _check_same_modelspace(self, other, caller=None):
+        """
+        the channel indices of self are used for other, so the orbits and the two- and three-body channels have to agree
+        """
+        if( self.ms is other.ms ): return
+        if( caller is None ): caller = sys._getframe(1).f_code.co_name
+        same = self.ms is not None and other.ms is not None and self.ms.rank == other.ms.rank and \
+                [ o.get_nljz() for o in self.ms.orbits.orbits ] == [ o.get_nljz() for o in other.ms.orbits.orbits ]
+        if( same and self.ms.rank >= 2 ):
+            same = [ ch.get_JPZ()+(ch.get_number_states(),) for ch in self.ms.two.channels ] == \
+                    [ ch.get_JPZ()+(ch.get_number_states(),) for ch in other.ms.two.channels ]
+        if( same and self.ms.rank >= 3 ):
+            three = [ None if ms.three is None else [ ch.get_JPT()+(ch.get_number_states(),) for ch in ms.three.channels ] for ms in (self.ms, other.ms) ]
+            iorbs = [ None if ms.iorbits is None else [ o.get_nlj() for o in ms.iorbits.orbits ] for ms in (self.ms, other.ms) ]
+            same = three[0] == three[1] and iorbs[0] == iorbs[1]
+        if( not same ):
+            raise ValueError("Operators on different model spaces cannot be combined in " + caller)
+    def scale(self, alpha):
+        """
+        in-place self <- alpha * self
+        """
+        self.zero *= alpha
+        if( self.one is not None ): self.one *= alpha
+        for key, block in self.two.items():
+            if( self.dense ): block *= alpha
+            else: self.two[key] = { idx: alpha*me for idx, me in block.items() }
+        for key, block in self.three.items():
+            self.three[key] = { idx: alpha*me for idx, me in block.items() }
+        return self
+    def axpy(self, alpha, other):
+        """
+        in-place self <- self + alpha * other
+        """
+        self._check_compatible( other )
+        self.zero += alpha * other.zero
+        if( self.one is not None ): self.one += alpha * other.one
+        for key, block in self.two.items():
+            if( self.dense and other.dense ):
+                block += alpha * other.two[key]
+            elif( self.dense ):
+                for (bra,ket), me in other.two[key].items(): block[bra,ket] += alpha * me
+            else:
+                for (bra,ket), me in other.get_2bme_items(*key): block[(bra,ket)] = block.get((bra,ket), 0.0) + alpha * me
+        for key, block in self.three.items():
+            for idx, me in other.three[key].items(): block[idx] = block.get(idx, 0.0) + alpha * me
+        return self
+    def __add__(self, other):
+        if( not isinstance(other, Operator) ): return NotImplemented
+        return self.copy().axpy( 1.0, other )
+    def __sub__(self, other):
+        if( not isinstance(other, Operator) ): return NotImplemented
+        return self.copy().axpy( -1.0, other )
+    def __mul__(self, alpha):
+        if( isinstance(alpha, Operator) ): return NotImplemented
+        return self.copy().scale( alpha )
+    def __rmul__(self, alpha):
+        return self.__mul__( alpha )
+
+    def get_2bme_full_block(self, chbra, chket):
+        """
+        returns the channel pair (chbra,chket) as a dense matrix also for chbra < chket
+        """
+        two = self.ms.two
+        Jbra = two.get_channel(chbra).J
+        Jket = two.get_channel(chket).J
+        if( chbra >= chket and (chbra,chket) in self.two ): return self.get_2bme_block(chbra,chket)
+        if( chbra < chket and (chket,chbra) in self.two ): return self.get_2bme_block(chket,chbra).T * (-1)**(Jket-Jbra)
+        return np.zeros( (two.get_channel(chbra).get_number_states(), two.get_channel(chket).get_number_states()) )
+    def product(self, other):
+        """
+        channel-wise product of the two-body parts of the scalar (rankJ=0, rankZ=0) operators,
+        i.e., self * other in the two-particle space
+        output:
+            dict of dense matrices keyed by (chbra,chket), both orderings of the channels are included
+            because the product is in general not symmetric
+        """
+        if( self.rankJ != 0 or other.rankJ != 0 or self.rankZ != 0 or other.rankZ != 0 ):
+            raise ValueError("Channel-wise product is implemented only for rankJ=0 and rankZ=0 operators")
+        self._check_same_modelspace( other )
+        if( self.ms.rank <= 1 ): return {}
+        two = self.ms.two
+        nch = two.get_number_channels()
+        mats = {}
+        for ichbra in range(nch):
+            chbra = two.get_channel(ichbra)
+            for ichket in range(nch):
+                chket = two.get_channel(ichket)
+                if( chbra.J != chket.J or chbra.Z != chket.Z ): continue
+                if( chbra.P * chket.P * self.rankP * other.rankP != 1 ): continue
+                mat = np.zeros( (chbra.get_number_states(), chket.get_number_states()) )
+                for ich in range(nch):
+                    ch = two.get_channel(ich)
+                    if( ch.J != chbra.J or ch.Z != chbra.Z or ch.P != chbra.P * self.rankP ): continue
+                    mat += self.get_2bme_full_block(ichbra,ich) @ other.get_2bme_full_block(ich,ichket)
+                mats[(ichbra,ichket)] = mat
+        return mats
+    def commutator(self, other):
+        """
+        channel-wise [self, other] of the two-body parts, see product
+        """
+        AB = self.product( other )
+        BA = other.product( self )
+        return { key: AB[key] - BA[key] for key in AB.keys() }
+
+    def read_operator_file(self, filename, spfile=None, opfile2=None, comment="!", istore=None, A=None, mmap=False,
+            lazy=False, max_channels=None):
+        if( lazy ):
+            self._read_operator_lazy(filename, comment, max_channels)
+            return
+        if(filename.find(".opbin") != -1):
+            self._read_operator_binary(filename, mmap)
+            return
         if(filename.find(".snt") != -1):
             self._read_operator_snt(filename, comment, A)
             if( self.count_nonzero_1bme() + self.count_nonzero_2bme() == 0):
@@ -398,11 +757,12 @@ class Operator:
 
     def _read_operator_snt(self, filename, comment="!", A=None):
         f = open(filename, 'r')
-        line = f.readline()
-        b = True
+        lines = f.read().splitlines()
+        f.close()
+        n_line = 1
         zerobody=0
-        while b == True:
-            line = f.readline()
+        while lines[n_line].startswith(comment):
+            line = lines[n_line]
             if(line.find("zero body") != -1 or \
                     line.find("Zero body") != -1 or \
                     line.find("Zero Body") != -1):
@@ -413,33 +773,22 @@ class Operator:
                     line.find("Zero-Body") != -1):
                 data = line.split()
                 zerobody = float(data[3])
-            b = line.startswith(comment)
-        data = line.split()
+            n_line += 1
+        data = lines[n_line].split()
         norbs = int(data[0]) + int(data[1])
-
-        b = True
-        while b == True:
-            x = f.tell()
-            line = f.readline()
-            b = line.startswith(comment)
-        f.seek(x)
+        n_line = self._skip_comment_lines(lines, n_line+1, comment)
 
         orbs = Orbits()
         for i in range(norbs):
-            line = f.readline()
-            data = line.split()
+            data = lines[n_line+i].split()
             idx, n, l, j, z = int(data[0]), int(data[1]), int(data[2]), int(data[3]), int(data[4])
             orbs.add_orbit(n,l,j,z)
-        ms = ModelSpace()
-        ms.set_modelspace_from_orbits( orbs )
+        ms = ModelSpace.get_modelspace( orbits=orbs )
         self.allocate_operator( ms )
         self.set_0bme( zerobody )
 
-        b = True
-        while b == True:
-            line = f.readline()
-            b = line.startswith(comment)
-        data = line.split()
+        n_line = self._skip_comment_lines(lines, n_line+norbs, comment)
+        data = lines[n_line].split()
         n = int(data[0])
         method = int(data[1])
         if(A!=None): hw = float(data[2])
@@ -448,26 +797,13 @@ class Operator:
             print(" Need to set mass number! ")
             sys.exit()
         if(A!=None and method==10): fact1 = (1-1/float(A))*hw
+        n_line = self._skip_comment_lines(lines, n_line+1, comment)
 
+        data = self._parse_columns( lines[n_line:n_line+n], 3, comment )
+        self.set_1bme_batch( data[:,0], data[:,1], data[:,2]*fact1 )
 
-        b = True
-        while b == True:
-            x = f.tell()
-            line = f.readline()
-            b = line.startswith(comment)
-        f.seek(x)
-
-        for i in range(n):
-            line = f.readline()
-            data = line.split()
-            a, b, me = int(data[0]), int(data[1]), float(data[2])
-            self.set_1bme(a,b,me*fact1)
-
-        b = True
-        while b == True:
-            line = f.readline()
-            b = line.startswith(comment)
-        data = line.split()
+        n_line = self._skip_comment_lines(lines, n_line+n, comment)
+        data = lines[n_line].split()
         n = int(data[0])
         method = int(data[1])
         if(A!=None): hw = float(data[2])
@@ -476,30 +812,36 @@ class Operator:
             print(" Need to set mass number! ")
             sys.exit()
         if(A!=None and method==10): fact2 = hw/float(A)
+        n_line = self._skip_comment_lines(lines, n_line+1, comment)
 
-        b = True
-        while b == True:
-            x = f.tell()
-            line = f.readline()
-            b = line.startswith(comment)
-        f.seek(x)
+        if( n == 0 or self.ms.rank <= 1 ): return
+        scalar = (self.rankJ==0 and self.rankZ==0 and self.rankP==1)
+        ncols = 7
+        if( scalar and not (A!=None and method==10) ): ncols = 6
+        data = self._parse_columns( lines[n_line:n_line+n], ncols, comment )
+        a, b, c, d, Jab = [ data[:,x].astype(int) for x in range(5) ]
+        if( scalar ):
+            Jcd = Jab
+            me = data[:,5]
+        else:
+            Jcd, me = data[:,5].astype(int), data[:,6]
+        if(A!=None and method==10):
+            me = me + data[:,6]*fact2
+        self.set_2bme_batch( a, b, c, d, Jab, Jcd, me )
 
-        for i in range(int(data[0])):
-            line = f.readline()
-            data = line.split()
-            if(self.rankJ==0 and self.rankZ==0 and self.rankP==1):
-                a, b, c, d = int(data[0]), int(data[1]), int(data[2]), int(data[3])
-                Jab, me = int(data[4]), float(data[5])
-                Jcd = Jab
-            else:
-                a, b, c, d = int(data[0]), int(data[1]), int(data[2]), int(data[3])
-                Jab, Jcd, me = int(data[4]), int(data[5]), float(data[6])
-            if(A!=None and method==10):
-                Tcm = float(data[6])
-                self.set_2bme_from_indices(a,b,c,d,Jab,Jcd,me + Tcm*fact2)
-            else:
-                self.set_2bme_from_indices(a,b,c,d,Jab,Jcd,me)
-        f.close()
+    def _skip_comment_lines(self, lines, n_line, comment="!"):
+        while n_line < len(lines) and lines[n_line].startswith(comment): n_line += 1
+        return n_line
+
+    def _parse_columns(self, lines, ncols, comment="!"):
+        """
+        parse the first ncols numbers of each line into a float array of shape (len(lines), ncols)
+        """
+        text = "\n".join( lines )
+        if( text.find(comment) == -1 ):
+            data = np.array( text.split(), dtype=float )
+            if( len(data) == len(lines)*ncols ): return data.reshape( len(lines), ncols )
+        return np.array( [ line.split(comment)[0].split()[:ncols] for line in lines ], dtype=float ).reshape( len(lines), ncols )
 
     def _read_lotta_format_old(self, filename, ime ):
         orbs = Orbits(verbose=False)
@@ -521,8 +863,7 @@ class Operator:
             n_j = int(entry[2])
             #if(2*n_n + n_l != 2): continue
             orbs.add_orbit(n_n, n_l, n_j, 1)
-        ms = ModelSpace(rank=1)
-        ms.set_modelspace_from_orbits( orbs )
+        ms = ModelSpace.get_modelspace( orbits=orbs, rank=1 )
         self.allocate_operator( ms )
         self.set_0bme( 0.0 )
 
@@ -561,8 +902,7 @@ class Operator:
             n_l = int(entry[2])
             n_j = int(entry[3])
             orbs.add_orbit(n_n, n_l, n_j, 1)
-        ms = ModelSpace(rank=1)
-        ms.set_modelspace_from_orbits( orbs )
+        ms = ModelSpace.get_modelspace( orbits=orbs, rank=1 )
         self.allocate_operator( ms )
         self.set_0bme( 0.0 )
 
@@ -581,7 +921,7 @@ class Operator:
             if( abs(me) < 1.e-8): continue
             self.set_1bme( i, j, me )
 
-    def _read_general_operator(self, filename, comment="!"):
+    def _read_general_operator(self, filename, comment="!", nlines=1<<20):
         if(filename.find(".gz") != -1): f = gzip.open(filename, "r")
         else: f = open(filename,"r")
         header = f.readline()
@@ -593,67 +933,52 @@ class Operator:
         emax = int(dat[3])
         e2max = int(dat[4])
 
-        ms = ModelSpace()
-        ms.set_modelspace_from_boundaries( emax=emax )
+        ms = ModelSpace.get_modelspace( emax=emax )
         self.allocate_operator( ms )
         iorbits = OrbitsIsospin( emax=emax )
         orbits = ms.orbits
-        data = f.readline()
-        self.set_0bme( float(data) )
-        for oi in iorbits.orbits:
-            pi = orbits.get_orbit_index( oi.n, oi.l, oi.j, -1)
-            ni = orbits.get_orbit_index( oi.n, oi.l, oi.j,  1)
-            for oj in iorbits.orbits:
-                pj = orbits.get_orbit_index( oj.n, oj.l, oj.j, -1)
-                nj = orbits.get_orbit_index( oj.n, oj.l, oj.j,  1)
-                if( (-1)**(oi.l+oj.l) * self.rankP != 1): continue
-                if( self._triag(oi.j, oj.j, 2*self.rankJ ) ): continue
-                data = [ float(x) for x in f.readline().split() ]
-                if( abs(data[0]) > 1.e-10 ): self.set_1bme( pi,pj,data[0] )
-                if( abs(data[1]) > 1.e-10 ): self.set_1bme( ni,nj,data[1] )
-                if( abs(data[2]) > 1.e-10 ): self.set_1bme( ni,pj,data[2] )
-                if( abs(data[3]) > 1.e-10 ): self.set_1bme( pi,nj,data[3] )
-
-        norbs = iorbits.get_num_orbits()+1
-        for i in range(1,norbs):
-            oi = iorbits.get_orbit(i)
-            pi = orbits.get_orbit_index(oi.n, oi.l, oi.j, -1)
-            ni = orbits.get_orbit_index(oi.n, oi.l, oi.j,  1)
-            for j in range(1,i+1):
-                oj = iorbits.get_orbit(j)
-                pj = orbits.get_orbit_index(oj.n, oj.l, oj.j, -1)
-                nj = orbits.get_orbit_index(oj.n, oj.l, oj.j,  1)
-                if( 2*oi.n+oi.l+2*oj.n+oj.l > e2max ): continue
-
-                for k in range(1,norbs):
-                    ok = iorbits.get_orbit(k)
-                    pk = orbits.get_orbit_index(ok.n, ok.l, ok.j, -1)
-                    nk = orbits.get_orbit_index(ok.n, ok.l, ok.j,  1)
-                    for l in range(1,k+1):
-                        ol = iorbits.get_orbit(l)
-                        pl = orbits.get_orbit_index(ol.n, ol.l, ol.j, -1)
-                        nl = orbits.get_orbit_index(ol.n, ol.l, ol.j,  1)
-                        if( 2*ok.n+ok.l+ 2*ol.n+ol.l > e2max ): continue
-                        if( (-1)**( oi.l+oj.l+ok.l+ol.l ) * self.rankP != 1): continue
-                        for Jij in range( int(abs( oi.j-oj.j ))//2, (oi.j+oj.j)//2+1 ):
-                            for Jkl in range( int(abs( ok.j-ol.j ))//2, (ok.j+ol.j)//2+1 ):
-                                if( self._triag(Jij, Jkl, self.rankJ ) ): continue
-                                data = [ float(x) for x in f.readline().split() ]
-                                if( abs(data[0]) > 1.e-10 ): self.set_2bme_from_indices(pi,pj,pk,pl,Jij,Jkl,data[0])
-                                if( abs(data[1]) > 1.e-10 ): self.set_2bme_from_indices(pi,pj,pk,nl,Jij,Jkl,data[1])
-                                if( abs(data[2]) > 1.e-10 ): self.set_2bme_from_indices(pi,pj,nk,pl,Jij,Jkl,data[2])
-                                if( abs(data[3]) > 1.e-10 ): self.set_2bme_from_indices(pi,pj,nk,nl,Jij,Jkl,data[3])
-                                if( abs(data[4]) > 1.e-10 ): self.set_2bme_from_indices(pi,nj,pk,nl,Jij,Jkl,data[4])
-                                if( abs(data[5]) > 1.e-10 ): self.set_2bme_from_indices(pi,nj,nk,pl,Jij,Jkl,data[5])
-                                if( abs(data[6]) > 1.e-10 ): self.set_2bme_from_indices(pi,nj,nk,nl,Jij,Jkl,data[6])
-                                if( abs(data[7]) > 1.e-10 ): self.set_2bme_from_indices(ni,pj,nk,pl,Jij,Jkl,data[7])
-                                if( abs(data[8]) > 1.e-10 ): self.set_2bme_from_indices(ni,pj,nk,nl,Jij,Jkl,data[8])
-                                if( abs(data[9]) > 1.e-10 ): self.set_2bme_from_indices(ni,nj,nk,nl,Jij,Jkl,data[9])
+        stream = _NumberStream( f )
+        i1, j1 = _me2j_one_indices( iorbits, self.rankJ, self.rankP )
+        zero = stream.take(1)
+        one = stream.take(4*len(i1))
+        if( len(zero) != 1 or len(one) != 4*len(i1) ):
+            f.close()
+            print("The number of entries in " + filename + " is inconsistent with the header!!")
+            return False
+        self.set_0bme( zero[0] )
+        proton, neutron = orbits.get_isospin_to_pn( iorbits )
+
+        # pp, nn, np, pn in the line order, so that the later entries win as in set_1bme
+        a = np.column_stack( (proton[i1], neutron[i1], neutron[i1], proton[i1]) ).ravel()
+        b = np.column_stack( (proton[j1], neutron[j1], proton[j1], neutron[j1]) ).ravel()
+        nonzero = np.abs(one) > 1.e-10
+        self.set_1bme_batch( a[nonzero], b[nonzero], one[nonzero] )
+
+        # pppp, pppn, ppnp, ppnn, pnpn, pnnp, pnnn, npnp, npnn, nnnn
+        pn = ( proton, neutron )
+        columns = [ (0,0,0,0), (0,0,0,1), (0,0,1,0), (0,0,1,1), (0,1,0,1), (0,1,1,0), (0,1,1,1), (1,0,1,0), (1,0,1,1), (1,1,1,1) ]
+        consistent = True
+        for i, j, k, l, Jij, Jkl in _iter_me2j_two_indices( iorbits, e2max, self.rankJ, self.rankP, nlines ):
+            me = stream.take( 10*len(i) )
+            if( len(me) != 10*len(i) ):
+                consistent = False
+                break
+            a = np.column_stack( [ pn[col[0]][i] for col in columns ] ).ravel()
+            b = np.column_stack( [ pn[col[1]][j] for col in columns ] ).ravel()
+            c = np.column_stack( [ pn[col[2]][k] for col in columns ] ).ravel()
+            d = np.column_stack( [ pn[col[3]][l] for col in columns ] ).ravel()
+            nonzero = np.abs(me) > 1.e-10
+            self.set_2bme_batch( a[nonzero], b[nonzero], c[nonzero], d[nonzero], \
+                    np.repeat(Jij,10)[nonzero], np.repeat(Jkl,10)[nonzero], me[nonzero] )
+        if( not consistent or len(stream.take(1)) != 0 ):
+            f.close()
+            print("The number of entries in " + filename + " is inconsistent with the header!!")
+            return False
         f.close()
+        return True
     def _read_3b_operator_readabletxt(self, filename, comment="!"):
         if( len( self.ms.three.channels ) == 0 ):
-            ms = ModelSpace()
-            ms.set_modelspace_from_boundaries( emax=6, e2max=6, e3max=6 )
+            ms = ModelSpace.get_modelspace( emax=6, e2max=6, e3max=6 )
             self.allocate_operator( ms )
         iorbits = self.ms.iorbits
         f = open(filename,"r")
@@ -668,15 +993,8 @@ class Operator:
             if(abs(ME) > 1.e-6): self.set_3bme_from_indices(i,j,k,Jij,Tij,l,m,n,Jlm,Tlm,Jbra,Tbra,Jket,Tket,ME)
             line = f.readline()
         f.close()
-    def _read_general_operator_navratil(self, filename, comment="!"):
-        emax=16
-        ms = ModelSpace()
-        ms.set_modelspace_from_boundaries( emax=emax, e2max=emax )
-        self.allocate_operator( ms )
-        iorbits = OrbitsIsospin( emax=emax )
-        orbits = ms.orbits
-
-        if(filename.find(".gz") != -1): f = gzip.open(filename, "r")
+    def _read_general_operator_navratil(self, filename, comment="!", emax=16, nlines=1<<20):
+        if(filename.find(".gz") != -1): f = gzip.open(filename, "rt")
         else: f = open(filename,"r")
         header = f.readline()
         while header[0] == comment:
@@ -691,34 +1009,204 @@ class Operator:
             header = f.readline()
         line = header
 
-        while len(line) != 0:
-            data = [ int(x) for x in line.split()[:-1] ]
-            data.append(float(line.split()[-1]))
-            oi = iorbits.get_orbit( data[0] )
-            oj = iorbits.get_orbit( data[1] )
-            ok = iorbits.get_orbit( data[2] )
-            ol = iorbits.get_orbit( data[3] )
-            ni = orbits.get_orbit_index(oi.n, oi.l, oi.j, 1)
-            nj = orbits.get_orbit_index(oj.n, oj.l, oj.j, 1)
-            pk = orbits.get_orbit_index(ok.n, ok.l, ok.j,-1)
-            pl = orbits.get_orbit_index(ol.n, ol.l, ol.j,-1)
-            if(abs(data[-1]) > 1.e-10): self.set_2bme_from_indices(ni,nj,pk,pl,data[4],data[5],data[-1])
-            line = f.readline()
+        ms = ModelSpace.get_modelspace( emax=emax, e2max=emax )
+        self.allocate_operator( ms )
+        iorbits = OrbitsIsospin( emax=emax )
+        orbits = ms.orbits
+        proton, neutron = orbits.get_isospin_to_pn( iorbits )
+
+        ncols = len(line.split())
+        stream = _NumberStream( f )
+        data = np.array( line.split(), dtype=float )
+        while True:
+            data = np.concatenate( ( data, stream.take( ncols*nlines-len(data) ) ) )
+            if( len(data) == 0 ): break
+            if( len(data) % ncols != 0 ):
+                f.close()
+                print("Truncated line at the end of " + filename)
+                return False
+            data = data.reshape(-1,ncols)
+            me = data[:,-1]
+            nonzero = np.abs(me) > 1.e-10
+            i, j, k, l, Jij, Jkl = [ data[nonzero,x].astype(int) for x in range(6) ]
+            self.set_2bme_batch( neutron[i], neutron[j], proton[k], proton[l], Jij, Jkl, me[nonzero] )
+            data = np.zeros(0)
         f.close()
+        return True
 
     def write_operator_file(self, filename):
+        if(filename.find(".opbin") != -1):
+            self._write_operator_binary( filename )
+            return
         if(filename.find(".snt") != -1):
             self._write_operator_snt( filename )
-        if(filename.find(".op.me2j") != -1):
+        elif(filename.find(".op.me2j") != -1):
             self._write_general_operator( filename )
-        if(filename.find(".me2j") != -1):
+        elif(filename.find(".me2j") != -1):
             if(self.rankJ==0 and self.rankP==1 and self.rankZ==0):
                 print("Not implemented yet")
             else:
                 self._write_general_operator( filename )
-        if(filename.find(".lotta") != -1):
+        elif(filename.find(".lotta") != -1):
             self._write_operator_lotta( filename )
 
+    _binary_magic = b"NUCLOPB1"
+    def _binary_header(self):
+        """
+        header of the binary format and the total number of float64 data
+        """
+        orbits = self.ms.orbits
+        header = {"rankJ":self.rankJ, "rankP":self.rankP, "rankZ":self.rankZ, "reduced":self.reduced,
+                "rank":self.ms.rank, "emax":self.ms.emax, "e2max":self.ms.e2max, "zero":self.zero,
+                "orbits":[ list(o.get_nljz()) for o in orbits.orbits ], "channels":[], "blocks":[]}
+        offset = orbits.get_num_orbits()**2
+        if( self.ms.rank >= 2 ):
+            two = self.ms.two
+            header["channels"] = [ list(channel.get_JPZ()) for channel in two.channels ]
+            for ichbra, ichket in self.two.keys():
+                nbra = two.get_channel(ichbra).get_number_states()
+                nket = two.get_channel(ichket).get_number_states()
+                header["blocks"].append( [ichbra, ichket, nbra, nket, offset] )
+                offset += nbra*nket
+        return header, offset
+
+    def _encode_binary_header(self, header, hlen=None):
+        hstr = json.dumps( header ).encode()
+        if( hlen is None ): hlen = len(hstr) + 64
+        hstr += b" " * ( hlen - len(hstr) )
+        hstr += b" " * ( (-len(hstr)) % 8 )
+        return self._binary_magic + np.array( [len(hstr)], dtype="<u8" ).tobytes() + hstr
+
+    def _write_operator_binary(self, filename):
+        """
+        binary format:
+            8 bytes magic, 8 bytes header length (little endian), json header,
+            padding to 8 bytes, then float64 data: one-body matrix followed by
+            one contiguous row-major array per two-body channel pair (listed in header["blocks"])
+        """
+        if( self.ms.rank >= 3 ):
+            print("Three-body part is not supported in " + sys._getframe().f_code.co_name )
+            return
+        header, size = self._binary_header()
+        f = open(filename, "wb")
+        f.write( self._encode_binary_header( header ) )
+        f.write( np.ascontiguousarray( self.one, dtype="<f8" ).tobytes() )
+        for ichbra, ichket, nbra, nket, offset in header["blocks"]:
+            f.write( np.ascontiguousarray( self.get_2bme_block(ichbra,ichket), dtype="<f8" ).tobytes() )
+        f.close()
+
+    def _map_binary_storage(self, filename):
+        """
+        replace the freshly allocated (dense) storage by a writable memory map of a new binary file,
+        so that a reader fills the file directly; _finish_binary_storage has to be called afterwards
+        """
+        header, size = self._binary_header()
+        hstr = self._encode_binary_header( header )
+        f = open(filename, "wb")
+        f.write( hstr )
+        f.truncate( len(hstr) + 8*size )
+        f.close()
+        data = np.memmap( filename, dtype="<f8", mode="r+", offset=len(hstr), shape=(size,) )
+        norbs = self.ms.orbits.get_num_orbits()
+        self.one = data[:norbs*norbs].reshape( norbs, norbs )
+        for ichbra, ichket, nbra, nket, offset in header["blocks"]:
+            self.two[(ichbra,ichket)] = data[offset:offset+nbra*nket].reshape( nbra, nket )
+
+    def _finish_binary_storage(self, filename):
+        """
+        flush the memory map of _map_binary_storage and write the final header (ranks and zero-body part)
+        """
+        if( isinstance( self.one, np.memmap ) ): self.one.flush()
+        elif( isinstance( self.one.base, np.memmap ) ): self.one.base.flush()
+        old, data_offset = self._read_binary_header( filename )
+        header, size = self._binary_header()
+        hstr = self._encode_binary_header( header, data_offset-16 )
+        if( len(hstr) != data_offset ):
+            print("Header does not fit in " + filename)
+            return False
+        f = open(filename, "r+b")
+        f.write( hstr )
+        f.close()
+        return True
+
+    def _read_operator_lazy(self, filename, comment="!", max_channels=None):
+        """
+        The lazy mode works on the binary format. A text (.op.me2j or .navratil) file is converted once
+        into a channel-blocked binary file next to it (filename + ".opbin"), which is reused as long as
+        it is newer than the text file. Two-body blocks are then decoded on demand (see _LazyChannelBlocks).
+        """
+        if(filename.find(".opbin") != -1):
+            self._read_operator_binary(filename, lazy=True, max_channels=max_channels)
+            return
+        if(filename.find(".op.me2j") == -1 and filename.find(".navratil") == -1):
+            print("Lazy mode is not supported for " + filename + ", the whole file is read.")
+            self.read_operator_file(filename, comment=comment)
+            return
+        binfile = filename + ".opbin"
+        if( not os.path.exists(binfile) or os.path.getmtime(binfile) < os.path.getmtime(filename) ):
+            tmpfile = binfile + ".tmp"
+            self.dense = True
+            self._binary_target = tmpfile
+            success = False
+            try:
+                if(filename.find(".op.me2j") != -1): success = self._read_general_operator(filename, comment)
+                else: success = self._read_general_operator_navratil(filename, comment)
+                success = success and os.path.exists(tmpfile) and self._finish_binary_storage(tmpfile)
+            finally:
+                self._binary_target = None
+                if( not success ):
+                    self.one = None
+                    self.two = {}
+                    if( os.path.exists(tmpfile) ): os.remove( tmpfile )
+            if( not success ):
+                print("No lazy cache is written for " + filename)
+                return
+            self.one = None
+            self.two = {}
+            os.replace( tmpfile, binfile )
+        self._read_operator_binary(binfile, lazy=True, max_channels=max_channels)
+
+    def _read_binary_header(self, filename):
+        f = open(filename, "rb")
+        if( f.read(8) != self._binary_magic ):
+            f.close()
+            print("Not a binary operator file: " + filename)
+            return None, None
+        hlen = int( np.frombuffer( f.read(8), dtype="<u8" )[0] )
+        header = json.loads( f.read(hlen).decode() )
+        f.close()
+        return header, 16+hlen
+
+    def _read_operator_binary(self, filename, mmap=False, lazy=False, max_channels=None):
+        header, data_offset = self._read_binary_header(filename)
+        if( header is None ): return
+        self.rankJ = header["rankJ"]
+        self.rankP = header["rankP"]
+        self.rankZ = header["rankZ"]
+        self.reduced = header["reduced"]
+        orbs = Orbits()
+        for nljz in header["orbits"]: orbs.add_orbit(*nljz)
+        ms = ModelSpace.get_modelspace( orbits=orbs, e2max=header["e2max"], rank=header["rank"] )
+        if( ms.rank >= 2 and [ list(channel.get_JPZ()) for channel in ms.two.channels ] != header["channels"] ):
+            print("Two-body channels are inconsistent with the header in " + filename)
+            return
+        if( mmap or lazy ):
+            data = np.memmap( filename, dtype="<f8", mode="c", offset=data_offset )
+        else:
+            data = np.fromfile( filename, dtype="<f8", offset=data_offset )
+        self.ms = ms
+        self.dense = True
+        self.zero = header["zero"]
+        norbs = orbs.get_num_orbits()
+        self.one = np.array( data[:norbs*norbs] ).reshape( norbs, norbs )
+        self.two = {}
+        self.three = {}
+        if( lazy ):
+            self.two = _LazyChannelBlocks( filename, data_offset, header["blocks"], max_channels )
+            return
+        for ichbra, ichket, nbra, nket, offset in header["blocks"]:
+            self.two[(ichbra,ichket)] = data[offset:offset+nbra*nket].reshape( nbra, nket )
+
     def write_nme_file(self):
         """
         Create an input file of the transit.exe for double-beta decay nuclear matrix element calcualtions
@@ -739,70 +1227,32 @@ class Operator:
         f.write(out)
         f.close()
 
-    def _write_general_operator(self, filename):
-        f = open(filename, "w")
+    def _write_general_operator(self, filename, chunk_size=1<<18):
+        if(filename.find(".gz") != -1): f = gzip.open(filename, "wt")
+        else: f = open(filename, "w", buffering=1<<20)
         f.write(" Written by python script \n")
         f.write(" {:3d} {:3d} {:3d} {:3d} {:3d}\n".format( self.rankJ, self.rankP, self.rankZ, self.ms.emax, self.ms.e2max ))
         f.write("{:14.8f}\n".format( self.zero ) )
 
         orbits = self.ms.orbits
         iorbits = OrbitsIsospin( emax=self.ms.emax )
-        norbs = iorbits.get_num_orbits() + 1
-        for i in range(1,norbs):
-            oi = iorbits.get_orbit(i)
-            pi = orbits.get_orbit_index(oi.n, oi.l, oi.j, -1)
-            ni = orbits.get_orbit_index(oi.n, oi.l, oi.j,  1)
-            for j in range(1,norbs):
-                oj = iorbits.get_orbit(j)
-                pj = orbits.get_orbit_index(oj.n, oj.l, oj.j, -1)
-                nj = orbits.get_orbit_index(oj.n, oj.l, oj.j,  1)
-                if( (-1)**( oi.l+oj.l ) * self.rankP != 1): continue
-                if( self._triag( oi.j, oj.j, 2*self.rankJ ) ): continue
-                me_pp = 0.0; me_nn = 0.0; me_np = 0.0; me_pn = 0.0
-                if(pi>=0 and pj>=0 ):
-                    me_pp = self.get_1bme(pi,pj)
-                    me_nn = self.get_1bme(ni,nj)
-                    me_np = self.get_1bme(ni,pj)
-                    me_pn = self.get_1bme(pi,nj)
-                f.write("{:14.8f} {:14.8f} {:14.8f} {:14.8f}\n".format(\
-                        me_pp, me_nn, me_np, me_pn ) )
+        proton, neutron = orbits.get_isospin_to_pn( iorbits )
+        i1, j1 = _me2j_one_indices( iorbits, self.rankJ, self.rankP )
+        pi, ni, pj, nj = proton[i1]-1, neutron[i1]-1, proton[j1]-1, neutron[j1]-1
+        one = np.column_stack( (self.one[pi,pj], self.one[ni,nj], self.one[ni,pj], self.one[pi,nj]) )
+        f.write( _format_rows( "%14.8f %14.8f %14.8f %14.8f", one ) )
 
-        for i in range(1,norbs):
-            oi = iorbits.get_orbit(i)
-            pi = orbits.get_orbit_index(oi.n, oi.l, oi.j, -1)
-            ni = orbits.get_orbit_index(oi.n, oi.l, oi.j,  1)
-            for j in range(1,i+1):
-                oj = iorbits.get_orbit(j)
-                pj = orbits.get_orbit_index(oj.n, oj.l, oj.j, -1)
-                nj = orbits.get_orbit_index(oj.n, oj.l, oj.j,  1)
-                if( oi.e + oj.e > self.ms.e2max ): continue
-
-                for k in range(1,norbs):
-                    ok = iorbits.get_orbit(k)
-                    pk = orbits.get_orbit_index(ok.n, ok.l, ok.j, -1)
-                    nk = orbits.get_orbit_index(ok.n, ok.l, ok.j,  1)
-                    for l in range(1,k+1):
-                        ol = iorbits.get_orbit(k)
-                        pl = orbits.get_orbit_index(ol.n, ol.l, ol.j, -1)
-                        nl= orbits.get_orbit_index(ol.n, ol.l, ol.j,  1)
-                        if( ok.e + ol.e > self.ms.e2max ): continue
-                        if( (-1)**( oi.l+oj.l+ok.l+ol.l ) * self.rankP != 1): continue
-                        for Jij in range( int(abs( oi.j-oj.j ))//2, ( oi.j+oj.j )//2+1 ):
-                            for Jkl in range( int(abs( ok.j-ol.j ))//2, (ok.j+ol.j)//2+1 ):
-                                if( self._triag(Jij, Jkl, self.rankJ ) ): continue
-
-                                me_pppp = self.get_2bme_from_indices(pi,pj,pk,pl,Jij,Jkl)
-                                me_pppn = self.get_2bme_from_indices(pi,pj,pk,nl,Jij,Jkl)
-                                me_ppnp = self.get_2bme_from_indices(pi,pj,nk,pl,Jij,Jkl)
-                                me_ppnn = self.get_2bme_from_indices(pi,pj,nk,nl,Jij,Jkl)
-                                me_pnpn = self.get_2bme_from_indices(pi,nj,pk,nl,Jij,Jkl)
-                                me_pnnp = self.get_2bme_from_indices(pi,nj,nk,pl,Jij,Jkl)
-                                me_pnnn = self.get_2bme_from_indices(pi,nj,nk,nl,Jij,Jkl)
-                                me_npnp = self.get_2bme_from_indices(ni,pj,nk,pl,Jij,Jkl)
-                                me_npnn = self.get_2bme_from_indices(ni,pj,nk,nl,Jij,Jkl)
-                                me_nnnn = self.get_2bme_from_indices(ni,nj,nk,nl,Jij,Jkl)
-                                f.write("{:14.8f} {:14.8f} {:14.8f} {:14.8f} {:14.8f} {:14.8f} {:14.8f} {:14.8f} {:14.8f} {:14.8f} \n".format(\
-                                        me_pppp, me_pppn, me_ppnp, me_ppnn, me_pnpn, me_pnnp, me_pnnn, me_npnp, me_npnn, me_nnnn))
+        pn = ( proton, neutron )
+        # pppp, pppn, ppnp, ppnn, pnpn, pnnp, pnnn, npnp, npnn, nnnn
+        columns = [ (0,0,0,0), (0,0,0,1), (0,0,1,0), (0,0,1,1), (0,1,0,1), (0,1,1,0), (0,1,1,1), (1,0,1,0), (1,0,1,1), (1,1,1,1) ]
+        fmt = " ".join( ["%14.8f"]*10 ) + " "
+        for i, j, k, l, Jij, Jkl in _iter_me2j_two_indices( iorbits, self.ms.e2max, self.rankJ, self.rankP, chunk_size ):
+            a = np.column_stack( [ pn[col[0]][i] for col in columns ] ).ravel()
+            b = np.column_stack( [ pn[col[1]][j] for col in columns ] ).ravel()
+            c = np.column_stack( [ pn[col[2]][k] for col in columns ] ).ravel()
+            d = np.column_stack( [ pn[col[3]][l] for col in columns ] ).ravel()
+            mes = self.get_2bme_batch( a, b, c, d, np.repeat(Jij,10), np.repeat(Jkl,10) )
+            f.write( _format_rows( fmt, mes.reshape(-1,10) ) )
         f.close()
 
     def _write_operator_snt(self, filename):
@@ -811,32 +1261,26 @@ class Operator:
         for o in orbits.orbits:
             if( o.z ==-1 ): p_norbs += 1
             if( o.z == 1 ): n_norbs += 1
-        prt = ""
-        prt  += " {:3d} {:3d} {:3d}\n".format( self.rankJ, self.rankP, self.rankZ )
-        prt += "! model space \n"
-        prt += " {0:3d} {1:3d} {2:3d} {3:3d} \n".format( p_norbs, n_norbs, 0, 0 )
+        f = open(filename, "w", buffering=1<<20)
+        f.write(" {:3d} {:3d} {:3d}\n".format( self.rankJ, self.rankP, self.rankZ ))
+        f.write("! model space \n")
+        f.write(" {0:3d} {1:3d} {2:3d} {3:3d} \n".format( p_norbs, n_norbs, 0, 0 ))
         norbs = orbits.get_num_orbits()+1
         for i in range(1,norbs):
             o = orbits.get_orbit(i)
-            prt += "{0:5d} {1:3d} {2:3d} {3:3d} {4:3d} \n".format( i, o.n, o.l, o.j, o.z )
+            f.write("{0:5d} {1:3d} {2:3d} {3:3d} {4:3d} \n".format( i, o.n, o.l, o.j, o.z ))
 
-        norbs = orbits.get_num_orbits()+1
-        prt += "! one-body part\n"
-        prt += "{0:5d} {1:3d}\n".format( self.count_nonzero_1bme(), 0 )
-        for i in range(1,norbs):
-            for j in range(1,norbs):
-                me = self.get_1bme(i,j)
-                if( abs(me) < 1.e-10): continue
-                prt += "{0:3d} {1:3d} {2:15.8f}\n".format( i, j, me )
+        f.write("! one-body part\n")
+        f.write("{0:5d} {1:3d}\n".format( self.count_nonzero_1bme(), 0 ))
+        ii, jj = np.nonzero( np.abs(self.one) >= 1.e-10 )
+        f.write( _format_rows( "%3d %3d %15.8f", np.column_stack( (ii+1, jj+1, self.one[ii,jj]) ) ) )
         if( self.ms.rank==1 ):
-            prt += "! two-body part\n"
-            prt += "{0:10d} {1:3d}\n".format( 0, 0 )
-            f = open(filename, "w")
-            f.write(prt)
+            f.write("! two-body part\n")
+            f.write("{0:10d} {1:3d}\n".format( 0, 0 ))
             f.close()
             return
-        prt += "! two-body part\n"
-        prt += "{0:10d} {1:3d}\n".format( self.count_nonzero_2bme(), 0 )
+        f.write("! two-body part\n")
+        f.write("{0:10d} {1:3d}\n".format( self.count_nonzero_2bme(), 0 ))
         scalar = False
         if(self.rankJ == 0 and self.rankZ == 0): scalar = True
         two = self.ms.two
@@ -847,35 +1291,34 @@ class Operator:
                 if( self._triag( chbra.J, chket.J, self.rankJ )): continue
                 if( chbra.P * chket.P * self.rankP != 1): continue
                 if( abs(chbra.Z-chket.Z) != self.rankZ): continue
-                for bra, ket in self.two[(ichbra,ichket)].keys():
-                    a = chbra.orbit1_index[bra]
-                    b = chbra.orbit2_index[bra]
-                    c = chket.orbit1_index[ket]
-                    d = chket.orbit2_index[ket]
-                    if(scalar):
-                        prt += "{0:3d} {1:3d} {2:3d} {3:3d} {4:3d} {5:15.8f}\n".format( a, b, c, d, chket.J, self.two[(ichbra,ichket)][(bra,ket)])
-                    else:
-                        prt += "{0:3d} {1:3d} {2:3d} {3:3d} {4:3d} {5:3d} {6:15.8f}\n".format( a, b, c, d, chbra.J, chket.J, self.two[(ichbra,ichket)][(bra,ket)])
-        f = open(filename, "w")
-        f.write(prt)
+                items = self.get_2bme_items(ichbra,ichket)
+                if( len(items) == 0 ): continue
+                bra = np.array( [ idx[0] for idx, me in items ], dtype=int )
+                ket = np.array( [ idx[1] for idx, me in items ], dtype=int )
+                mes = np.array( [ me for idx, me in items ] )
+                a = np.asarray( chbra.orbit1_index )[bra]
+                b = np.asarray( chbra.orbit2_index )[bra]
+                c = np.asarray( chket.orbit1_index )[ket]
+                d = np.asarray( chket.orbit2_index )[ket]
+                if(scalar):
+                    f.write( _format_rows( "%3d %3d %3d %3d %3d %15.8f", \
+                            np.column_stack( (a, b, c, d, np.full(len(a), chket.J), mes) ) ) )
+                else:
+                    f.write( _format_rows( "%3d %3d %3d %3d %3d %3d %15.8f", \
+                            np.column_stack( (a, b, c, d, np.full(len(a), chbra.J), np.full(len(a), chket.J), mes) ) ) )
         f.close()
 
     def _write_operator_lotta(self, filename):
         orbits = self.ms.orbits
         norbs = orbits.get_num_orbits()
-        prt = "{:>4s} {:>4s} {:>4s} {:>4s} {:>4s} {:>4s} {:>18s}\n".format( "NN","LN","JN","NP","LP","JP","ME" )
-        for i in range(1,norbs+1):
-            for j in range(1,norbs+1):
-                oi = orbits.get_orbit(i)
-                oj = orbits.get_orbit(j)
-                if(oi.z != 1): continue
-                if(oj.z !=-1): continue
-                me = self.get_1bme(i,j)
-                if( oi.j==29 and oj.j==29): print(me)
-                if( abs(me) < 1.e-10): continue
-                prt += "{:4d} {:4d} {:4d} {:4d} {:4d} {:4d} {:18.8e}\n".format( oi.n, oi.l, oi.j, oj.n, oj.l, oj.j, me )
-        f = open(filename, "w")
-        f.write(prt)
+        nlj = np.column_stack( (orbits.n[1:], orbits.l[1:], orbits.j[1:]) )
+        z = orbits.z[1:]
+        mask = ( z[:,None] == 1 ) & ( z[None,:] == -1 ) & ( np.abs(self.one) >= 1.e-10 )
+        ii, jj = np.nonzero( mask )
+        f = open(filename, "w", buffering=1<<20)
+        f.write("{:>4s} {:>4s} {:>4s} {:>4s} {:>4s} {:>4s} {:>18s}\n".format( "NN","LN","JN","NP","LP","JP","ME" ))
+        rows = np.column_stack( (nlj[ii], nlj[jj], self.one[ii,jj]) ) if len(ii) else []
+        f.write( _format_rows( "%4d %4d %4d %4d %4d %4d %18.8e", rows ) )
         f.close()
         return
 
@@ -957,21 +1400,58 @@ class Operator:
                 if( self._triag( chbra.J, chket.J, self.rankJ )): continue
                 if( chbra.P * chket.P * self.rankP != 1): continue
                 if( abs(chbra.Z-chket.Z) != self.rankZ): continue
-                for bra in range(chbra.get_number_states()):
-                    a = chbra.orbit1_index[bra]
-                    b = chbra.orbit2_index[bra]
-                    ketmax = chket.get_number_states()
-                    if( ichbra==ichket ): ketmax=bra+1
-                    for ket in range(ketmax):
-                        c = chket.orbit1_index[ket]
-                        d = chket.orbit2_index[ket]
-
-                        me = self._get_embed_1bme_2(a,b,c,d,ichbra,ichket,scalar) / float(A-1)
-                        me_original = self.get_2bme_from_indices(a,b,c,d,chbra.J,chket.J)
-                        me += me_original
-                        if(abs(me) > 1.e-8): self.set_2bme_from_indices(a,b,c,d,chbra.J,chket.J,me)
+                me = self._get_embed_1bme_2_block(ichbra,ichket,scalar) / float(A-1)
+                if( ichbra==ichket ): me = np.tril(me) + np.tril(me,-1).T
+                me_original = self.get_2bme_block(ichbra,ichket)
+                me += me_original
+                self.set_2bme_block(ichbra,ichket,me,mask=np.abs(me) > 1.e-8)
         self.one = np.zeros( (orbits.get_num_orbits(), orbits.get_num_orbits() ))
 
+    def _get_embed_1bme_2_block(self,ichbra,ichket,scalar):
+        """
+        block version of _get_embed_1bme_2, returns the (bra, ket) matrix of the channel pair
+        """
+        two = self.ms.two
+        chbra = two.get_channel(ichbra)
+        chket = two.get_channel(ichket)
+        Jab = chbra.J
+        Jcd = chket.J
+        lam = self.rankJ
+        orbits = self.ms.orbits
+        jj = orbits.j
+        a = np.array( chbra.orbit1_index )[:,None]
+        b = np.array( chbra.orbit2_index )[:,None]
+        c = np.array( chket.orbit1_index )[None,:]
+        d = np.array( chket.orbit2_index )[None,:]
+        ja, jb, jc, jd = jj[a], jj[b], jj[c], jj[d]
+        shape = ( chbra.get_number_states(), chket.get_number_states() )
+        me = np.zeros( shape )
+        if( scalar ):
+            phase = 1 - 2*( ((ja+jb)//2 - Jab)%2 )
+            me += np.where( b==d, self.one[a-1,c-1], 0.0 )
+            me += np.where( a==c, self.one[b-1,d-1], 0.0 )
+            me -= np.where( a==d, self.one[b-1,c-1] * phase, 0.0 )
+            me -= np.where( b==c, self.one[a-1,d-1] * phase, 0.0 )
+        else:
+            terms = [ (b==d, self.one[a-1,c-1],  1 - 2*( ((ja+jb)//2 + Jcd)%2 ), (jc, ja, jb)),
+                      (a==c, self.one[b-1,d-1],  1 - 2*( ((jc+jd)//2 - Jab)%2 ), (jd, jb, ja)),
+                      (b==c, self.one[a-1,d-1], -1 + 2*( ((ja+jb+jc+jd)//2)%2 ), (jd, ja, jb)),
+                      (a==d, self.one[b-1,c-1], -1 + 2*( (Jcd - Jab)%2 ),        (jc, jb, ja)) ]
+            for mask, one, phase, (j1, j2, j3) in terms:
+                mask = np.broadcast_to( mask, shape )
+                if( not mask.any() ): continue
+                one = np.broadcast_to( one, shape )[mask]
+                phase = np.broadcast_to( phase, shape )[mask]
+                j1 = np.broadcast_to( j1, shape )[mask]
+                j2 = np.broadcast_to( j2, shape )[mask]
+                j3 = np.broadcast_to( j3, shape )[mask]
+                sixj = np.array( [ wigner_6j(Jab,Jcd,lam,x*0.5,y*0.5,z*0.5) for x, y, z in zip(j1.tolist(), j2.tolist(), j3.tolist()) ] )
+                me[mask] += one * phase * sixj
+            me *= np.sqrt( (2*Jab+1)*(2*Jcd+1) ) * (-1.0)**lam
+        me = np.where( a==b, me/np.sqrt(2.0), me )
+        me = np.where( c==d, me/np.sqrt(2.0), me )
+        return me
+
     def _get_embed_1bme_2(self,a,b,c,d,ichbra,ichket,scalar):
         two = self.ms.two
         chbra = two.get_channel(ichbra)
@@ -993,90 +1473,199 @@ class Operator:
             if(a==b): me /= np.sqrt(2.0)
             if(c==d): me /= np.sqrt(2.0)
             return me
-        if(b==d): me += self.get_1bme(a,c) * (-1.0)**( (oa.j+ob.j)//2 + Jcd     ) * N( wigner_6j(Jab,Jcd,lam,oc.j*0.5,oa.j*0.5,ob.j*0.5) )
-        if(a==c): me += self.get_1bme(b,d) * (-1.0)**( (oc.j+od.j)//2 - Jab     ) * N( wigner_6j(Jab,Jcd,lam,od.j*0.5,ob.j*0.5,oa.j*0.5) )
-        if(b==c): me -= self.get_1bme(a,d) * (-1.0)**( (oa.j+ob.j+oc.j+od.j)//2 ) * N( wigner_6j(Jab,Jcd,lam,od.j*0.5,oa.j*0.5,ob.j*0.5) )
-        if(a==d): me -= self.get_1bme(b,c) * (-1.0)**( Jcd - Jab                ) * N( wigner_6j(Jab,Jcd,lam,oc.j*0.5,ob.j*0.5,oa.j*0.5) )
+        if(b==d): me += self.get_1bme(a,c) * (-1.0)**( (oa.j+ob.j)//2 + Jcd     ) * wigner_6j(Jab,Jcd,lam,oc.j*0.5,oa.j*0.5,ob.j*0.5)
+        if(a==c): me += self.get_1bme(b,d) * (-1.0)**( (oc.j+od.j)//2 - Jab     ) * wigner_6j(Jab,Jcd,lam,od.j*0.5,ob.j*0.5,oa.j*0.5)
+        if(b==c): me -= self.get_1bme(a,d) * (-1.0)**( (oa.j+ob.j+oc.j+od.j)//2 ) * wigner_6j(Jab,Jcd,lam,od.j*0.5,oa.j*0.5,ob.j*0.5)
+        if(a==d): me -= self.get_1bme(b,c) * (-1.0)**( Jcd - Jab                ) * wigner_6j(Jab,Jcd,lam,oc.j*0.5,ob.j*0.5,oa.j*0.5)
         me *= np.sqrt( (2*Jab+1)*(2*Jcd+1) ) * (-1.0)**lam
         if(a==b): me /= np.sqrt(2.0)
         if(c==d): me /= np.sqrt(2.0)
         return me
     def spin_tensor_decomposition(self):
+        """
+        returns the list of the rank 0, 1, and 2 spin-tensor components of the scalar two-body part
+        <ab J|V^k|cd J> = (-1)^J (2k+1) sum_{LSL'S'} <ab J|LS J> <cd J|L'S' J> {L S J; S' L' k}
+                          sum_{J'} (-1)^J' (2J'+1) {L S J'; S' L' k} sum_{a'b'c'd'} <a'b' J'|LS J'> <c'd' J'|L'S' J'> <a'b' J'|V|c'd' J'>
+        where a' (b', c', d') runs over the orbits with the same n, l, z as a (b, c, d)
+        """
         if(self.rankJ != 0):
             print("Spin-tensor decomposition is not defined for a non-scalar operator")
             return None
         ops = []
-        ops.append( Operator( rankJ=self.rankJ, rankP=self.rankP, rankZ=self.rankZ, ms=self.ms ) )
-        ops.append( Operator( rankJ=self.rankJ, rankP=self.rankP, rankZ=self.rankZ, ms=self.ms ) )
-        ops.append( Operator( rankJ=self.rankJ, rankP=self.rankP, rankZ=self.rankZ, ms=self.ms ) )
-        ms = self.ms.two
-        orbits = ms.orbits
-        for ch_key in self.two.keys():
-            ichbra = ch_key[0]
-            ichket = ch_key[1]
-            chbra = ms.get_channel(ichbra)
-            chket = ms.get_channel(ichket)
-            J = chket.J
-            for key in self.two[ch_key].keys():
-                a = chbra.orbit1_index[key[0]]
-                b = chbra.orbit2_index[key[0]]
-                c = chket.orbit1_index[key[1]]
-                d = chket.orbit2_index[key[1]]
+        ops.append( Operator( rankJ=self.rankJ, rankP=self.rankP, rankZ=self.rankZ, ms=self.ms, dense=self.dense ) )
+        ops.append( Operator( rankJ=self.rankJ, rankP=self.rankP, rankZ=self.rankZ, ms=self.ms, dense=self.dense ) )
+        ops.append( Operator( rankJ=self.rankJ, rankP=self.rankP, rankZ=self.rankZ, ms=self.ms, dense=self.dense ) )
+        if(self.ms.rank <= 1): return ops
+        two = self.ms.two
+        labels, T, U = self._ls_recoupling_matrices()
+
+        groups = {}
+        for ichbra, ichket in self.two.keys():
+            chbra = two.get_channel(ichbra)
+            chket = two.get_channel(ichket)
+            key = ( (chbra.P, chbra.Z), (chket.P, chket.Z) )
+            if( key not in groups ): groups[key] = []
+            groups[key].append( (ichbra, ichket) )
+
+        for (PZbra, PZket), ch_pairs in groups.items():
+            L_bra, S_bra = labels[PZbra][:,2], labels[PZbra][:,3]
+            L_ket, S_ket = labels[PZket][:,2], labels[PZket][:,3]
+            for rank in [0,1,2]:
+                X = np.zeros( (len(L_bra), len(L_ket)) )
+                for ichbra, ichket in ch_pairs:
+                    JJ = two.get_channel(ichbra).J
+                    W = T[ichbra] @ self.get_2bme_block(ichbra,ichket) @ T[ichket].T
+                    X += (-1)**JJ * (2*JJ+1) * self._sixj_matrix(L_bra, S_bra, JJ, S_ket, L_ket, rank) * W
+                for ichbra, ichket in ch_pairs:
+                    J = two.get_channel(ichbra).J
+                    sixj = self._sixj_matrix(L_bra, S_bra, J, S_ket, L_ket, rank)
+                    mat = (-1)**J * (2*rank+1) * U[ichbra].T @ ( sixj * X ) @ U[ichket]
+                    ops[rank].set_2bme_block(ichbra, ichket, mat, mask=np.abs(mat) > 1.e-10)
+        return ops
+
+    def _ls_recoupling_matrices(self):
+        """
+        jj -> LS recoupling matrices for each two-body channel
+        labels[(P,Z)]: array of (alpha, beta, L, S), alpha and beta label the (n,l,z) of the orbits
+        T[ich]: <(alpha beta) L S J | ab J> summed over all the j values of a and b in the channel
+        U[ich]: <(alpha beta) L S J | ab J> only for the stored ordering of (a, b)
+        """
+        two = self.ms.two
+        orbits = self.ms.orbits
+        nlz = []
+        for o in orbits.orbits:
+            if( (o.n, o.l, o.z) not in nlz ): nlz.append( (o.n, o.l, o.z) )
+        spatial = [ nlz.index( (o.n, o.l, o.z) ) for o in orbits.orbits ]
+        orbits_from_spatial = [ [ i+1 for i in range(len(spatial)) if spatial[i] == alpha ] for alpha in range(len(nlz)) ]
+
+        labels = {}
+        for alpha, (na, la, za) in enumerate(nlz):
+            for beta, (nb, lb, zb) in enumerate(nlz):
+                PZ = ( (-1)**(la+lb), (za+zb)//2 )
+                if( PZ not in labels ): labels[PZ] = []
+                for L in range( abs(la-lb), la+lb+1 ):
+                    for S in [0,1]:
+                        labels[PZ].append( (alpha, beta, L, S) )
+        row_from_label = {}
+        for PZ in labels.keys():
+            row_from_label[PZ] = { label: row for row, label in enumerate(labels[PZ]) }
+            labels[PZ] = np.array( labels[PZ], dtype=int ).reshape(-1,4)
+
+        T = []
+        U = []
+        for channel in two.channels:
+            J = channel.J
+            PZ = (channel.P, channel.Z)
+            rows = row_from_label[PZ]
+            Tch = np.zeros( (len(rows), channel.get_number_states()) )
+            Uch = np.zeros( (len(rows), channel.get_number_states()) )
+            for (alpha, beta, L, S), row in rows.items():
+                if( self._triag( L, S, J ) ): continue
+                la, lb = nlz[alpha][1], nlz[beta][1]
+                for a in orbits_from_spatial[alpha]:
+                    ja = orbits.get_orbit(a).j
+                    for b in orbits_from_spatial[beta]:
+                        if( (a,b) not in channel.index_from_indices ): continue
+                        jb = orbits.get_orbit(b).j
+                        idx = channel.index_from_indices[(a,b)]
+                        Tch[row,idx] += channel.phase_from_indices[(a,b)] * _ls_coupling(la, ja*0.5, lb, jb*0.5, L, S, J)
+            for idx in range(channel.get_number_states()):
+                a, b = channel.get_indices(idx)
                 oa = orbits.get_orbit(a)
                 ob = orbits.get_orbit(b)
-                oc = orbits.get_orbit(c)
-                od = orbits.get_orbit(d)
-
-                for rank in [0,1,2]:
-                    sum3 = 0.0
-                    for Lab in range( abs(oa.l-ob.l), oa.l+ob.l+1 ):
-                        for Sab in [0,1]:
-                            if(self._triag( Lab, Sab, J )): continue
-                            Cab = _ls_coupling(oa.l, oa.j*0.5, ob.l, ob.j*0.5, Lab, Sab, J)
-                            if(abs(Cab) < 1.e-10): continue
-                            for Lcd in range( abs(oc.l-od.l), oc.l+od.l+1 ):
-                                for Scd in [0,1]:
-                                    if(self._triag( Lcd, Scd, J )): continue
-                                    Ccd = _ls_coupling(oc.l, oc.j*0.5, od.l, od.j*0.5, Lcd, Scd, J)
-                                    if(abs(Ccd) < 1.e-10): continue
-                                    SixJ = N(wigner_6j(Lab,Sab,J,Scd,Lcd,rank))
-                                    if(abs(SixJ) < 1.e-10): continue
-
-                                    sum2 = 0.0
-                                    for JJ in range( max(abs(Lab-Sab),abs(Lcd-Scd)), min(Lab+Sab, Lcd+Scd)+1):
-                                        SixJJ = N(wigner_6j(Lab,Sab,JJ,Scd,Lcd,rank))
-                                        if(abs(SixJJ) < 1.e-10): continue
-                                        sum1 = 0.0
-                                        for jaa in [abs(2*oa.l-1), 2*oa.l+1]:
-                                            try:
-                                                aa = orbits.get_orbit_index(oa.n, oa.l, jaa, oa.z)
-                                            except:
-                                                continue
-                                            for jbb in [abs(2*ob.l-1), 2*ob.l+1]:
-                                                try:
-                                                    bb = orbits.get_orbit_index(ob.n, ob.l, jbb, ob.z)
-                                                except:
-                                                    continue
-                                                CCab = _ls_coupling(oa.l, jaa*0.5, ob.l, jbb*0.5, Lab, Sab, JJ)
-                                                for jcc in [abs(2*oc.l-1), 2*oc.l+1]:
-                                                    try:
-                                                        cc = orbits.get_orbit_index(oc.n, oc.l, jcc, oc.z)
-                                                    except:
-                                                        continue
-                                                    for jdd in [abs(2*od.l-1), 2*od.l+1]:
-                                                        try:
-                                                            dd = orbits.get_orbit_index(od.n, od.l, jdd, od.z)
-                                                        except:
-                                                            continue
-                                                        CCcd = _ls_coupling(oc.l, jcc*0.5, od.l, jdd*0.5, Lcd, Scd, JJ)
-                                                        sum1 += self.get_2bme_from_indices(aa,bb,cc,dd,JJ,JJ) * CCab * CCcd
-                                        sum2 += sum1 * SixJJ * (2*JJ+1)*(-1)**JJ
-                                    sum3 += sum2 * SixJ * Cab * Ccd
-                    ops[rank].set_2bme_from_indices(a,b,c,d,J,J, (-1)**J*(2*rank+1)*sum3)
-                sys.exit()
-        return ops
+                for L in range( abs(oa.l-ob.l), oa.l+ob.l+1 ):
+                    for S in [0,1]:
+                        if( self._triag( L, S, J ) ): continue
+                        row = rows[ (spatial[a-1], spatial[b-1], L, S) ]
+                        Uch[row,idx] = _ls_coupling(oa.l, oa.j*0.5, ob.l, ob.j*0.5, L, S, J)
+            T.append( Tch )
+            U.append( Uch )
+        return labels, T, U
+
+    def _sixj_matrix(self, L_bra, S_bra, J, S_ket, L_ket, k):
+        """
+        {L S J; S' L' k} for all the combinations of the bra (L,S) and ket (L',S') labels
+        """
+        LS_bra, inv_bra = np.unique( np.array([L_bra, S_bra]).T, axis=0, return_inverse=True )
+        LS_ket, inv_ket = np.unique( np.array([L_ket, S_ket]).T, axis=0, return_inverse=True )
+        table = np.array( [ [ wigner_6j(L, S, J, Sp, Lp, k) for Lp, Sp in LS_ket.tolist() ] for L, S in LS_bra.tolist() ] )
+        return table.reshape( len(LS_bra), len(LS_ket) )[ np.ravel(inv_bra) ][ :, np.ravel(inv_ket) ]
+
+
+
+def _load_operator_worker(args):
+    filename, kwargs, tmpdir = args
+    op = Operator( filename=filename, dense=True, **kwargs )
+    fd, fn = tempfile.mkstemp( suffix=".opbin", dir=tmpdir )
+    os.close( fd )
+    op._write_operator_binary( fn )
+    return fn
+
+def _sum_operator_worker(args):
+    filenames, coeffs, kwargs, tmpdir = args
+    op = _sum_operators( filenames, coeffs, kwargs )
+    fd, fn = tempfile.mkstemp( suffix=".opbin", dir=tmpdir )
+    os.close( fd )
+    op._write_operator_binary( fn )
+    return fn
+
+def _sum_operators(filenames, coeffs, kwargs):
+    acc = None
+    for filename, coef in zip( filenames, coeffs ):
+        op = Operator( filename=filename, dense=True, **kwargs )
+        if( acc is None ): acc = op.scale( coef )
+        else: acc.axpy( coef, op )
+    return acc
+
+def _read_binary_files(filenames):
+    ops = []
+    for filename in filenames:
+        op = Operator()
+        op._read_operator_binary( filename )
+        ops.append( op )
+    return ops
 
+def load_operators(filenames, workers=None, **kwargs):
+    """
+    read many operator files, with a pool of workers processes if workers > 1
+    The files are parsed in the workers and handed back in the binary (.opbin) format.
+    kwargs are passed to Operator (e.g., rankJ, rankP, rankZ for .snt files).
+    output: list of dense Operators in the order of filenames
+    """
+    if( workers is None or workers <= 1 or len(filenames) <= 1 ):
+        return [ Operator( filename=filename, dense=True, **kwargs ) for filename in filenames ]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with ProcessPoolExecutor( max_workers=workers ) as pool:
+            bins = list( pool.map( _load_operator_worker, [ (filename, kwargs, tmpdir) for filename in filenames ] ) )
+        return _read_binary_files( bins )
+    finally:
+        shutil.rmtree( tmpdir )
 
+def sum_operator_files(filenames, coeffs=None, workers=None, **kwargs):
+    """
+    sum_i coeffs[i] * (operator in filenames[i]) as one dense Operator
+    With workers > 1, each worker reduces every workers-th file into its own partial sum
+    and the partial sums are added in a fixed order.
+    """
+    if( coeffs is None ): coeffs = [1.0] * len(filenames)
+    if( len(coeffs) != len(filenames) ):
+        print("The numbers of files and coefficients are different in " + sys._getframe().f_code.co_name )
+        return None
+    if( workers is None or workers <= 1 or len(filenames) <= 1 ):
+        return _sum_operators( filenames, coeffs, kwargs )
+    workers = min( workers, len(filenames) )
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tasks = [ (filenames[i::workers], coeffs[i::workers], kwargs, tmpdir) for i in range(workers) ]
+        with ProcessPoolExecutor( max_workers=workers ) as pool:
+            bins = list( pool.map( _sum_operator_worker, tasks ) )
+        ops = _read_binary_files( bins )
+    finally:
+        shutil.rmtree( tmpdir )
+    acc = ops[0]
+    for op in ops[1:]: acc.axpy( 1.0, op )
+    return acc
 
 def main():
     ms = ModelSpace.ModelSpace()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import numpy as np
 class Orbit:
     def __init__(self):
         self.n = -1
@@ -24,7 +25,72 @@ class OrbitIsospin:
     def get_nlj(self):
         return (self.n, self.l, self.j)
 
-class Orbits:
+class _OrbitArrays:
+    """
+    NumPy arrays of the quantum numbers (n, l, j, e, parity, and z for Orbits),
+    indexed by the orbit index, i.e., entry 0 is a placeholder (0).
+    The arrays are rebuilt after add_orbit.
+    """
+    _keys = ("n", "l", "j", "e")
+    _arrays = None
+    def _get_arrays(self):
+        if( self._arrays is None ):
+            arrays = {}
+            for key in self._keys:
+                arrays[key] = np.array( [0] + [ getattr(o, key) for o in self.orbits ], dtype=int )
+            arrays["parity"] = 1 - 2*( arrays["l"]%2 )
+            shape = tuple( arrays[key].max()+1 for key in self._keys[:3] )
+            if( "z" in self._keys ): shape += (2,)
+            table = np.full( shape, -1, dtype=int )
+            table[self._nlj_index( *[ arrays[key][1:] for key in self._keys if key != "e" ] )] = np.arange( 1, len(self.orbits)+1 )
+            arrays["index"] = table
+            self._arrays = arrays
+        return self._arrays
+    def _nlj_index(self, n, l, j, z=None):
+        if( z is None ): return (n, l, j)
+        return (n, l, j, (np.asarray(z)+1)//2)
+    @property
+    def n(self):
+        return self._get_arrays()["n"]
+    @property
+    def l(self):
+        return self._get_arrays()["l"]
+    @property
+    def j(self):
+        return self._get_arrays()["j"]
+    @property
+    def e(self):
+        return self._get_arrays()["e"]
+    @property
+    def parity(self):
+        return self._get_arrays()["parity"]
+    def get_orbit_indices(self, *nljz):
+        """
+        vectorized get_orbit_index, -1 for the orbits not in the list
+        """
+        table = self._get_arrays()["index"]
+        qn = [ np.asarray(x, dtype=int) for x in nljz ]
+        idx = self._nlj_index( *qn )
+        ok = np.ones( np.broadcast(*qn).shape, dtype=bool )
+        for x, nmax in zip( idx, table.shape ): ok &= ( x >= 0 ) & ( x < nmax )
+        idx = tuple( np.where(ok, x, 0) for x in idx )
+        return np.where( ok, table[idx], -1 )
+    def get_pair_parity(self):
+        """
+        (-1)**(la+lb) for all the (a, b)
+        """
+        return self.parity[:,None] * self.parity[None,:]
+    def get_triangle_mask(self, J):
+        """
+        True for the (a, b) that can couple to J (not doubled)
+        """
+        mask = ( np.abs(self.j[:,None]-self.j[None,:]) <= 2*J ) & ( 2*J <= self.j[:,None]+self.j[None,:] )
+        mask[0,:] = False
+        mask[:,0] = False
+        return mask
+
+class Orbits(_OrbitArrays):
+    _keys = ("n", "l", "j", "z", "e")
     def __init__(self, emax=None, lmax=None, shell_model_space=None, verbose=False):
         self.nljz_idx = {}
         self.orbits  = []
@@ -47,6 +113,7 @@ class Orbits:
         orb = Orbit()
         orb.set_orbit(*nljz)
         self.orbits.append( orb )
+        self._arrays = None
         self.emax = max(self.emax, 2*nljz[0]+nljz[1])
         self.lmax = max(self.lmax, nljz[1])
     def add_orbit_from_label(self,string):
@@ -88,6 +155,38 @@ class Orbits:
         return self.nljz_idx[nljz]
     def get_num_orbits(self):
         return self.norbs
+    @property
+    def z(self):
+        return self._get_arrays()["z"]
+    def get_pair_tz(self):
+        """
+        (za+zb)/2 for all the (a, b)
+        """
+        return ( self.z[:,None] + self.z[None,:] )//2
+    def get_pair_mask(self, rankJ=0, rankP=1, rankZ=0):
+        """
+        True for the (a, b) allowed in a one-body operator with the ranks
+        """
+        mask = self.get_triangle_mask( rankJ )
+        mask &= self.get_pair_parity() * rankP == 1
+        mask &= np.abs( self.z[:,None] - self.z[None,:] ) == 2*rankZ
+        return mask
+    def get_isospin_to_pn(self, iorbits):
+        """
+        proton and neutron orbit indices for each isospin orbit index (entry 0 is a placeholder, -1 if missing)
+        """
+        proton = self.get_orbit_indices( iorbits.n, iorbits.l, iorbits.j, -1 )
+        neutron = self.get_orbit_indices( iorbits.n, iorbits.l, iorbits.j, 1 )
+        proton[0] = 0
+        neutron[0] = 0
+        return proton, neutron
+    def get_pn_to_isospin(self, iorbits):
+        """
+        isospin orbit index for each orbit index (entry 0 is a placeholder, -1 if missing)
+        """
+        idx = iorbits.get_orbit_indices( self.n, self.l, self.j )
+        idx[0] = 0
+        return idx
     def set_orbits(self, emax=None, lmax=None, shell_model_space=None):
         if( emax != None):
             if( lmax==None ): lmax=emax
@@ -117,7 +216,7 @@ class Orbits:
             idx = self.get_orbit_index_from_orbit( o )
             print("{:3d},{:3d},{:3d},{:3d},{:3d},{:3d}".format(idx,*nljz,o.e) )
 
-class OrbitsIsospin:
+class OrbitsIsospin(_OrbitArrays):
     def __init__(self, emax=None, lmax=None, shell_model_space=None, verbose=False):
         self.nlj_idx = {}
         self.orbits  = []
@@ -140,6 +239,7 @@ class OrbitsIsospin:
         orb = OrbitIsospin()
         orb.set_orbit(*nlj)
         self.orbits.append( orb )
+        self._arrays = None
         self.emax = max(self.emax, 2*nlj[0]+nlj[1])
         self.lmax = max(self.lmax, nlj[1])
     def add_orbit_from_label(self,string):
@@ -170,6 +270,11 @@ class OrbitsIsospin:
         return self.nlj_idx[nlj]
     def get_num_orbits(self):
         return self.norbs
+    def get_pair_mask(self, rankJ=0, rankP=1):
+        """
+        True for the (a, b) allowed in a one-body operator with the ranks
+        """
+        return self.get_triangle_mask( rankJ ) & ( self.get_pair_parity() * rankP == 1 )
     def set_orbits(self, emax=None, lmax=None, shell_model_space=None):
         if( emax != None):
             if( lmax==None ): lmax=emax
@@ -1,63 +1,103 @@
 #!/usr/bin/env python3
+import numpy as np
 if(__package__==None or __package__==""):
     import OrbitsIsospin
 else:
     from . import OrbitsIsospin
+def _three_body_states(orbits, e2max, e3max):
+    """
+    enumerate every (a,b,c,Jab,Tab) with a >= b >= c once and distribute it to all the allowed (J,P,T)
+    output: dict (J,P,T) -> (a, b, c, Jab, Tab) arrays, each in the loop order of a, b, c, Jab, Tab
+    """
+    e, l, j = orbits.e[1:], orbits.l[1:], orbits.j[1:]
+    idx = np.arange( len(orbits.orbits) )
+    mask = ( idx[:,None,None] >= idx[None,:,None] ) & ( idx[None,:,None] >= idx[None,None,:] )
+    mask &= ( e[:,None,None] + e[None,:,None] <= e2max ) & ( e[:,None,None] + e[None,None,:] <= e2max )
+    mask &= ( e[None,:,None] + e[None,None,:] <= e2max )
+    mask &= ( e[:,None,None] + e[None,:,None] + e[None,None,:] <= e3max )
+    ia, ib, ic = np.nonzero( mask )
+
+    # (Jab, Tab)
+    Jmin = np.abs( j[ia]-j[ib] )//2
+    n = 2*( (j[ia]+j[ib])//2 - Jmin + 1 )
+    x = np.repeat( np.arange(len(ia)), n )
+    off = np.arange(len(x)) - np.repeat( np.cumsum(n)-n, n )
+    ia, ib, ic, Jab, Tab = ia[x], ib[x], ic[x], Jmin[x] + off//2, off%2
+    keep = ~( (ia==ib) & ((Jab+Tab)%2==0) )
+    ia, ib, ic, Jab, Tab = ia[keep], ib[keep], ic[keep], Jab[keep], Tab[keep]
+    P = 1 - 2*( (l[ia]+l[ib]+l[ic])%2 )
+
+    # total J (doubled) and T (doubled)
+    n = ( np.minimum( 2*Jab, j[ic] ) + 1 ) * ( Tab + 1 )
+    x = np.repeat( np.arange(len(ia)), n )
+    off = np.arange(len(x)) - np.repeat( np.cumsum(n)-n, n )
+    J = np.abs( 2*Jab[x]-j[ic[x]] ) + 2*( off//(Tab[x]+1) )
+    T = 1 + 2*( off%(Tab[x]+1) )
+    keep = J < 2*e3max+5
+    x, J, T = x[keep], J[keep], T[keep]
+
+    key = ( J//2 )*4 + ( 1-P[x] ) + ( T-1 )//2
+    order = np.argsort( key, kind="stable" )
+    x, key = x[order], key[order]
+    bounds = np.nonzero( np.diff(key) )[0] + 1
+    states = {}
+    for s in np.split( np.arange(len(x)), bounds ):
+        if( len(s) == 0 ): continue
+        k = key[s[0]]
+        y = x[s]
+        states[(2*(k//4)+1, 1-(k%4)//2*2, 1+2*(k%2))] = ( ia[y]+1, ib[y]+1, ic[y]+1, Jab[y], Tab[y] )
+    return states
+
 class ThreeBodyChannel:
-    def __init__(self,J=None,P=None,T=None,orbits=None,e2max=None,e3max=None):
+    def __init__(self,J=None,P=None,T=None,orbits=None,e2max=None,e3max=None,states=None):
+        """
+        states: (a, b, c, Jab, Tab) arrays of this channel, computed from orbits if not given
+        """
         self.J = J
         self.P = P
         self.T = T
         self.orbits = orbits
         self.e2max = e2max
         self.e3max = e3max
-        self.orbit1_index = []
-        self.orbit2_index = []
-        self.orbit3_index = []
-        self.J12_index = []
-        self.T12_index = []
-        self.index_from_indices = {}
+        self.orbit1_index = np.zeros(0, dtype=int)
+        self.orbit2_index = np.zeros(0, dtype=int)
+        self.orbit3_index = np.zeros(0, dtype=int)
+        self.J12_index = np.zeros(0, dtype=int)
+        self.T12_index = np.zeros(0, dtype=int)
+        self._index_from_indices = None
         self.number_states = 0
         if( self.J != None and self.P != None and self.T != None and orbits != None ):
-            self._set_three_body_channel()
+            self._set_three_body_channel(states)
             return
-    def _set_three_body_channel(self):
+    def _set_three_body_channel(self, states=None):
         orbs = self.orbits
         if(self.e2max==None): self.e2max = 2*orbs.emax
         if(self.e3max==None): self.e3max = 3*orbs.emax
-        for oa in orbs.orbits:
-            ia = orbs.get_orbit_index_from_orbit( oa )
-            for ob in orbs.orbits:
-                ib = orbs.get_orbit_index_from_orbit( ob )
-                if( ia < ib ): continue
-                if( oa.e + ob.e > self.e2max ): continue
-                for oc in orbs.orbits:
-                    ic = orbs.get_orbit_index_from_orbit( oc )
-                    if( ib < ic ): continue
-                    if( oa.e + oc.e > self.e2max ): continue
-                    if( ob.e + oc.e > self.e2max ): continue
-                    if( oa.e + ob.e + oc.e > self.e3max ): continue
-                    for Jab in range( abs(oa.j-ob.j)//2, (oa.j+ob.j)//2+1):
-                        for Tab in [0,1]:
-                            if( ia==ib and (Jab+Tab)%2==0 ): continue
-                            if( (-1)**(oa.l + ob.l + oc.l) != self.P ): continue
-                            if( self._triag( 2*Jab, oc.j, self.J ) ): continue
-                            if( self._triag( 2*Tab,    1, self.T ) ): continue
-                            self.orbit1_index.append( ia )
-                            self.orbit2_index.append( ib )
-                            self.orbit3_index.append( ic )
-                            self.J12_index.append( Jab )
-                            self.T12_index.append( Tab )
-                            idx = len( self.orbit1_index )-1
-                            self.index_from_indices[(ia,ib,ic,Jab,Tab)] = idx
-                            self.number_states = len( self.orbit1_index )
+        if( states is None ):
+            states = _three_body_states( orbs, self.e2max, self.e3max ).get( (self.J,self.P,self.T) )
+        if( states is None ): return
+        self.orbit1_index, self.orbit2_index, self.orbit3_index, self.J12_index, self.T12_index = states
+        self.number_states = len( self.orbit1_index )
+    @property
+    def index_from_indices(self):
+        """
+        dict (a,b,c,Jab,Tab) -> index in the channel, built on the first use
+        """
+        if( self._index_from_indices is None ):
+            keys = zip( self.orbit1_index.tolist(), self.orbit2_index.tolist(), self.orbit3_index.tolist(), \
+                    self.J12_index.tolist(), self.T12_index.tolist() )
+            self._index_from_indices = dict( zip( keys, range(self.number_states) ) )
+        return self._index_from_indices
+    @index_from_indices.setter
+    def index_from_indices(self, value):
+        self._index_from_indices = value
     def get_number_states(self):
         return self.number_states
     def get_indices(self,idx):
         return self.orbit1_index[idx], self.orbit2_index[idx], self.orbit3_index[idx], self.J12_index[idx], self.T12_index[idx]
     def get_orbits(self,idx):
         ia, ib, ic, Jab, Tab = self.get_indices(idx)
-        return self.orbits.get_orbit[ia], self.orbits.get_orbit[ib], self.orbits.get_orbit[ic], Jab, Tab
+        return self.orbits.get_orbit(ia), self.orbits.get_orbit(ib), self.orbits.get_orbit(ic), Jab, Tab
     def get_JPT(self):
         return self.J, self.P, self.T
     def _triag(self,J1,J2,J3):
@@ -76,11 +116,12 @@ class ThreeBodySpace:
         if( self.orbits != None ):
             if( self.e2max == None ): self.e2max = 2*self.orbits.emax
             if( self.e3max == None ): self.e3max = 3*self.orbits.emax
+            states = _three_body_states( self.orbits, self.e2max, self.e3max )
             for J in range(1,2*self.e3max+5,2):
                 for P in [1,-1]:
                     for T in [1,3]:
-                        channel = ThreeBodyChannel(J=J,P=P,T=T,orbits=self.orbits,e2max=e2max,e3max=e3max)
-                        if( channel.get_number_states() == 0): continue
+                        if( (J,P,T) not in states ): continue
+                        channel = ThreeBodyChannel(J=J,P=P,T=T,orbits=self.orbits,e2max=self.e2max,e3max=self.e3max,states=states[(J,P,T)])
                         self.channels.append( channel )
                         idx = len(self.channels) - 1
                         self.index_from_JPT[(J,P,T)] = idx
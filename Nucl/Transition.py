@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import numpy as np
-from sympy import N
-from sympy.physics.wigner import wigner_3j
 from scipy.special import factorial2
 from scipy.constants import physical_constants
+if(__package__==None or __package__==""):
+    from AngularMomentum import wigner_3j
+else:
+    from .AngularMomentum import wigner_3j
 def Rp2_to_Rch2( Rp2, Z, N, CODATA=True ):
     """
     inputs:
@@ -43,7 +45,7 @@ def ME_to_moment( ME, J, lam ):
         static moment
     """
     if( abs(ME) < 1.e-10 ): return 0
-    return np.sqrt(4**(lam-1) * 4 * np.pi / (2*lam+1) ) * N(wigner_3j(J,lam,J,-J,0,J)) * ME
+    return np.sqrt(4**(lam-1) * 4 * np.pi / (2*lam+1) ) * wigner_3j(J,lam,J,-J,0,J) * ME
 
 def BEM(ME, Jinit):
     """
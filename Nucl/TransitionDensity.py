@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import os, sys, copy, gzip, subprocess, time
+import os, sys, gzip, subprocess, time, json, hashlib, weakref
 import numpy as np
 if(__package__==None or __package__==""):
     import ModelSpace
@@ -7,78 +7,85 @@ else:
     from . import Orbits
     from . import ModelSpace
 
+_OBTD_DTYPE = np.dtype( [("a","<i4"), ("b","<i4"), ("jrank","<i4"), ("me","<f8")] )
+_TBTD_DTYPE = np.dtype( [("chbra","<i4"), ("chket","<i4"), ("bra","<i4"), ("ket","<i4"), ("jrank","<i4"), ("me","<f8")] )
+
 class TransitionDensity:
+    cache_dir = None
+    cache_max_size = 1<<32
+    _cache_magic = b"NUCLTDB2"
+    _channel_maps = weakref.WeakKeyDictionary()
     def __init__(self, Jbra=None, Jket=None, wflabel_bra=None, wflabel_ket=None, ms=None, filename=None, file_format="kshell", verbose=False):
         self.Jbra = Jbra
         self.Jket = Jket
         self.wflabel_bra = wflabel_bra
         self.wflabel_ket = wflabel_ket
-        self.ms = copy.deepcopy(ms)
+        self.ms = ms
         self.verbose = verbose
         self.one = {}
         self.two = {}
         self.three = {}
+        self._dense = {}
         if( ms != None ): self.allocate_density( ms )
         if( filename != None ): self.read_density_file( filename, file_format )
     def allocate_density( self, ms ):
-        self.ms = copy.deepcopy(ms)
-        orbits = ms.orbits
+        """
+        The channel pairs in self.two (and self.three) are created at the first write
+        """
+        self.ms = ms
         self.one = {}
-        two = ms.two
-        for ichbra in range(two.get_number_channels()):
-            chbra = two.get_channel(ichbra)
-            for ichket in range(two.get_number_channels()):
-                chket = two.get_channel(ichket)
-                self.two[(ichbra,ichket)] = {}
-        if(self.ms.rank==2): return
-        three = ms.three
-        for ichbra in range(three.get_number_channels()):
-            chbra = three.get_channel(ichbra)
-            for ichket in range(three.get_number_channels()):
-                chket = three.get_channel(ichket)
-                self.three[(ichbra,ichket)] = {}
+        self.two = {}
+        self.three = {}
+        self._dense = {}
     def count_nonzero_1btd(self):
         return len(self.one)
     def count_nonzero_2btd(self):
-        counter = 0
-        two = self.ms.two
-        nch = two.get_number_channels()
-        for i in range(nch):
-            chbra = two.get_channel(i)
-            for j in range(nch):
-                chket = two.get_channel(j)
-                counter += len( self.two[(i,j)] )
-        return counter
+        return sum( len(block) for block in self.two.values() )
     def set_1btd( self, a, b, jrank, me):
         orbits = self.ms.orbits
         oa = orbits.get_orbit(a)
         ob = orbits.get_orbit(b)
         me_rank = {jrank: me}
         self.one[(a,b,jrank)] = me
+        if( self._dense ): self._dense = {}
     def set_2btd_from_mat_indices( self, chbra, chket, bra, ket, jrank, me ):
+        if( (chbra,chket) not in self.two ): self.two[(chbra,chket)] = {}
         self.two[(chbra,chket)][(bra,ket,jrank)] = me
+        if( self._dense ): self._dense = {}
     def set_2btd_from_indices( self, a, b, c, d, Jab, Jcd, jrank, me ):
+        ichbra, ichket, bra, ket, phase = self._resolve_2btd_index( a, b, c, d, Jab, Jcd, jrank )
+        if( ichbra < 0 ): return
+        self.set_2btd_from_mat_indices(ichbra,ichket,bra,ket,jrank,me*phase)
+    def set_2btd_batch( self, a, b, c, d, Jab, Jcd, jrank, me ):
+        """
+        vectorized version of set_2btd_from_indices, forbidden entries are skipped
+        """
+        a, b, c, d, Jab, Jcd, jrank = [ np.asarray(x, dtype=int).ravel() for x in (a, b, c, d, Jab, Jcd, jrank) ]
+        me = np.asarray(me, dtype=float).ravel()
+        if(self.ms.rank <= 1 or len(a)==0): return
         two = self.ms.two
-        orbits = two.orbits
-        oa = orbits.get_orbit(a)
-        ob = orbits.get_orbit(b)
-        oc = orbits.get_orbit(c)
-        od = orbits.get_orbit(d)
-        Pab = (-1)**(oa.l+ob.l)
-        Pcd = (-1)**(oc.l+od.l)
-        Zab = (oa.z + ob.z)//2
-        Zcd = (oc.z + od.z)//2
+        ich_ab, idx_ab, ph_ab = two.lookup_from_indices( a, b, Jab )
+        ich_cd, idx_cd, ph_cd = two.lookup_from_indices( c, d, Jcd )
+        ok = (ich_ab >= 0) & (ich_cd >= 0) & (np.abs(Jab-Jcd) <= jrank) & (jrank <= Jab+Jcd)
+        vals = me * ph_ab * ph_cd
+        for chbra, chket, bra, ket, jr, v in zip( *[ x[ok].tolist() for x in (ich_ab, ich_cd, idx_ab, idx_cd, jrank, vals) ] ):
+            if( (chbra,chket) not in self.two ): self.two[(chbra,chket)] = {}
+            self.two[(chbra,chket)][(bra,ket,jr)] = v
+        if( self._dense ): self._dense = {}
+    def _resolve_2btd_index( self, a, b, c, d, Jab, Jcd, jrank ):
+        """
+        (a, b, c, d, Jab, Jcd) -> (chbra, chket, bra, ket, phase), chbra is -1 for the forbidden entries
+        """
         if( self._triag( Jab, Jcd, jrank )):
-            if(self.verbose): print("Warning: J, " + sys._getframe().f_code.co_name )
-            return
-        ichbra = two.get_index(Jab,Pab,Zab)
-        ichket = two.get_index(Jcd,Pcd,Zcd)
-        chbra = two.get_channel(ichbra)
-        chket = two.get_channel(ichket)
-        bra = chbra.index_from_indices[(a,b)]
-        ket = chket.index_from_indices[(c,d)]
-        phase = chbra.phase_from_indices[(a,b)] * chket.phase_from_indices[(c,d)]
-        self.set_2btd_from_mat_indices(ichbra,ichket,bra,ket,jrank,me*phase)
+            if(self.verbose): print("Warning: J, " + sys._getframe(1).f_code.co_name )
+            return -1, -1, -1, -1, 0
+        two = self.ms.two
+        ichbra, bra, ph_ab = two.lookup( a, b, Jab )
+        ichket, ket, ph_cd = two.lookup( c, d, Jcd )
+        if( ichbra < 0 or ichket < 0 ):
+            if(self.verbose): print("Warning: bra & ket index, " + sys._getframe(1).f_code.co_name )
+            return -1, -1, -1, -1, 0
+        return ichbra, ichket, bra, ket, ph_ab*ph_cd
     def set_2btd_from_orbits( self, oa, ob, oc, od, Jab, Jcd, jrank, me ):
         orbits = self.ms.orbits
         a = orbits.orbit_index_from_orbit( oa )
@@ -87,46 +94,16 @@ class TransitionDensity:
         d = orbits.orbit_index_from_orbit( od )
         self.set_2btd_from_indices( a, b, c, d, Jab, Jcd, jrank, me )
     def get_1btd(self,*args):
-        try:
-            return self.one[args]
-        except:
-            return 0
+        return self.one.get( args, 0 )
     def get_2btd_from_mat_indices(self, chbra, chket, bra, ket, jrank):
-        try:
-            return self.two[(chbra,chket)][(bra,ket,jrank)]
-        except:
+        if( (chbra,chket) not in self.two or (bra,ket,jrank) not in self.two[(chbra,chket)] ):
             if(self.verbose): print("Nothing here " + sys._getframe().f_code.co_name )
             return 0
+        return self.two[(chbra,chket)][(bra,ket,jrank)]
     def get_2btd_from_indices( self, a, b, c, d, Jab, Jcd, jrank ):
         if(self.ms.rank <= 1): return 0
-        two = self.ms.two
-        orbits = two.orbits
-        oa = orbits.get_orbit(a)
-        ob = orbits.get_orbit(b)
-        oc = orbits.get_orbit(c)
-        od = orbits.get_orbit(d)
-        Pab = (-1)**(oa.l+ob.l)
-        Pcd = (-1)**(oc.l+od.l)
-        Zab = (oa.z + ob.z)//2
-        Zcd = (oc.z + od.z)//2
-        if( self._triag( Jab, Jcd, jrank )):
-            if(self.verbose): print("Warning: J, " + sys._getframe().f_code.co_name )
-            return 0
-        try:
-            ichbra = two.get_index(Jab,Pab,Zab)
-            ichket = two.get_index(Jcd,Pcd,Zcd)
-        except:
-            if(self.verbose): print("Warning: channel bra & ket index, " + sys._getframe().f_code.co_name )
-            return 0
-        chbra = two.get_channel(ichbra)
-        chket = two.get_channel(ichket)
-        try:
-            bra = chbra.index_from_indices[(a,b)]
-            ket = chket.index_from_indices[(c,d)]
-        except:
-            if(self.verbose): print("Warning: bra & ket index, " + sys._getframe().f_code.co_name )
-            return 0
-        phase = chbra.phase_from_indices[(a,b)] * chket.phase_from_indices[(c,d)]
+        ichbra, ichket, bra, ket, phase = self._resolve_2btd_index( a, b, c, d, Jab, Jcd, jrank )
+        if( ichbra < 0 ): return 0
         return self.get_2btd_from_mat_indices(ichbra,ichket,bra,ket,jrank)*phase
     def get_2btd_from_orbits( self, oa, ob, oc, od, Jab, Jcd, jrank ):
         if(self.ms.rank <= 1): return 0
@@ -136,6 +113,56 @@ class TransitionDensity:
         c = orbits.orbit_index_from_orbit( oc )
         d = orbits.orbit_index_from_orbit( od )
         return self.get_2btd_from_indices( a, b, c, d, Jab, Jcd, jrank )
+    def get_1btd_matrix(self, jrank):
+        """
+        one-body density of rank jrank as a dense (norbs+1) x (norbs+1) matrix indexed by [a,b],
+        row and column 0 are zero. The matrix is cached (read-only) until the next set_1btd/set_2btd.
+        """
+        key = ("one", jrank)
+        if( key not in self._dense ):
+            norbs = self.ms.orbits.get_num_orbits()
+            mat = np.zeros( (norbs+1, norbs+1) )
+            for (a,b,jr), me in self.one.items():
+                if( jr == jrank ): mat[a,b] = me
+            mat.flags.writeable = False
+            self._dense[key] = mat
+        return self._dense[key]
+    def get_2btd_block(self, chbra, chket, jrank):
+        """
+        two-body density of rank jrank in the channel pair (chbra,chket) as a dense matrix,
+        cached (read-only) like get_1btd_matrix
+        """
+        key = (chbra, chket, jrank)
+        if( key not in self._dense ):
+            two = self.ms.two
+            mat = np.zeros( (two.get_channel(chbra).get_number_states(), two.get_channel(chket).get_number_states()) )
+            for (bra,ket,jr), me in self.two.get( (chbra,chket), {} ).items():
+                if( jr == jrank ): mat[bra,ket] = me
+            mat.flags.writeable = False
+            self._dense[key] = mat
+        return self._dense[key]
+    def _get_channel_map(self, ms):
+        """
+        for each two-body channel of ms: (channel index in self.ms, state indices, phases),
+        None if the channel does not exist in self.ms. The phase is 0 for the states not in self.ms.
+        The maps are shared by the densities on the same model space and are dropped together with the model spaces.
+        """
+        cache = self._channel_maps.setdefault( self.ms, weakref.WeakKeyDictionary() )
+        if( ms in cache ): return cache[ms]
+        two = self.ms.two
+        orbits = ms.orbits
+        idx_de = self.ms.orbits.get_orbit_indices( orbits.n, orbits.l, orbits.j, orbits.z )
+        maps = []
+        for ch in ms.two.channels:
+            ich = two.index_from_JPZ.get( ch.get_JPZ() )
+            if( ich is None ):
+                maps.append( None )
+                continue
+            ichs, idx, phase = two.lookup_from_indices( idx_de[ch.orbit1_index], idx_de[ch.orbit2_index], ch.J )
+            phase = np.where( ichs == ich, phase, 0 )
+            maps.append( (ich, np.where( ichs == ich, idx, 0 ), phase) )
+        cache[ms] = maps
+        return maps
 
     def _triag(self,J1,J2,J3):
         b = True
@@ -146,17 +173,120 @@ class TransitionDensity:
             print(" set file name!")
             return
         if( file_format=="kshell"):
-            self._read_td_kshell_format(filename)
+            if( not self._read_td_cache(filename, file_format) ): self._read_td_kshell_format(filename)
             if( self.count_nonzero_1btd() + self.count_nonzero_2btd() == 0):
                 print("The number of non-zero transition density matrix elements is 0 better to check: "+ filename + "!! " + \
                         "Jbra=" + str(self.Jbra) + " (wf label:"+ str(self.wflabel_bra)+"), Jket="+str(self.Jket)+" (wf label:"+str(self.wflabel_ket)+")")
             return
         if( file_format=="nutbar"):
-            self._read_td_nutbar_format(filename)
+            if( not self._read_td_cache(filename, file_format) ): self._read_td_nutbar_format(filename)
             if( self.count_nonzero_1btd() + self.count_nonzero_2btd() == 0):
                 print("The number of non-zero transition density matrix elements is 0 better to check: "+ filename + "!!")
             return
 
+    @classmethod
+    def set_cache_dir(cls, cache_dir, max_size=None):
+        """
+        directory for the binary cache of the parsed density files (None to disable)
+        max_size: total size (bytes) of the cache, the least recently used files are removed beyond it
+        """
+        if( cache_dir is not None and not os.path.exists(cache_dir) ): os.makedirs( cache_dir )
+        cls.cache_dir = cache_dir
+        if( max_size is not None ): cls.cache_max_size = max_size
+    def _get_cache_filename(self, filename, file_format):
+        st = os.stat( filename )
+        key = ( self._cache_magic, os.path.abspath(filename), st.st_size, st.st_mtime_ns, file_format )
+        return os.path.join( self.cache_dir, "density_" + hashlib.sha1( repr(key).encode() ).hexdigest() + ".tdbin" )
+    def _read_td_cache(self, filename, file_format):
+        """
+        read the density through the binary cache in cache_dir, the cache of the whole file is made at the first read
+        The cache is keyed by the path, size, and mtime of the file. returns False if the cache is not used.
+        """
+        if( self.cache_dir is None or not os.path.exists(filename) ): return False
+        fn = self._get_cache_filename( filename, file_format )
+        if( not os.path.exists(fn) ):
+            if( file_format=="kshell" ):
+                index = KshellDensityIndex( filename )
+                if( index.ms is None or len(index.blocks) == 0 ): return False
+                keys = sorted( index.get_keys(), key=lambda x: min( block[1] for block in index.blocks[x] ) )
+                self._write_td_cache( fn, index.ms.orbits, \
+                        ( index.load( key[0]/2, key[1], key[2]/2, key[3] ) for key in keys ) )
+            if( file_format=="nutbar" ):
+                self._read_td_nutbar_format( filename )
+                self._write_td_cache( fn, self.ms.orbits, [self] )
+            self._evict_td_cache( fn )
+            if( file_format=="nutbar" ): return True
+        if( not os.path.exists(fn) ): return False
+        return self._read_td_cache_file( fn, file_format )
+    def _write_td_cache(self, fn, orbits, tds):
+        """
+        binary format:
+            8 bytes magic, 8 bytes (<u8) position of the header,
+            OBTD and TBTD records (_OBTD_DTYPE, _TBTD_DTYPE) of each block, then the JSON header (orbits and blocks)
+        header["blocks"]: [2*Jbra, wflabel_bra, 2*Jket, wflabel_ket, OBTD offset, # of OBTD, TBTD offset, # of TBTD]
+        The offsets count from the end of the first 16 bytes. tds can be a generator, the blocks are written one by one.
+        """
+        header = {"orbits":[ list(o.get_nljz()) for o in orbits.orbits ], "blocks":[]}
+        offset = 0
+        try:
+            with open(fn+".tmp", "wb") as f:
+                f.write( self._cache_magic + np.zeros( 1, dtype="<u8" ).tobytes() )
+                for td in tds:
+                    one = np.array( [ (a,b,jr,me) for (a,b,jr), me in td.one.items() ], dtype=_OBTD_DTYPE )
+                    two = np.array( [ (chbra,chket,bra,ket,jr,me) for (chbra,chket), block in td.two.items() \
+                            for (bra,ket,jr), me in block.items() ], dtype=_TBTD_DTYPE )
+                    header["blocks"].append( [ int(round(2*td.Jbra)), td.wflabel_bra, int(round(2*td.Jket)), td.wflabel_ket, \
+                            offset, len(one), offset+one.nbytes, len(two) ] )
+                    f.write( one.tobytes() )
+                    f.write( two.tobytes() )
+                    offset += one.nbytes + two.nbytes
+                f.write( json.dumps( header ).encode() )
+                f.seek( 8 )
+                f.write( np.array( [16+offset], dtype="<u8" ).tobytes() )
+            os.replace( fn+".tmp", fn )
+        except OSError:
+            if( os.path.exists(fn+".tmp") ): os.remove( fn+".tmp" )
+    def _evict_td_cache(self, keep=None):
+        """
+        remove the least recently used cache files until the total size is below cache_max_size
+        """
+        files = [ os.path.join(self.cache_dir, x) for x in os.listdir(self.cache_dir) if x.startswith("density_") and x.endswith(".tdbin") ]
+        files = sorted( ( os.stat(x).st_mtime, os.stat(x).st_size, x ) for x in files )
+        total = sum( size for mtime, size, x in files )
+        for mtime, size, x in files:
+            if( total <= self.cache_max_size ): break
+            if( x == keep ): continue
+            os.remove( x )
+            total -= size
+    def _read_td_cache_file(self, fn, file_format):
+        f = open(fn, "rb")
+        if( f.read(8) != self._cache_magic ):
+            f.close()
+            return False
+        hpos = int( np.frombuffer( f.read(8), dtype="<u8" )[0] )
+        f.seek( hpos )
+        header = json.loads( f.read().decode() )
+        f.close()
+        os.utime( fn )
+        orbs = Orbits()
+        for nljz in header["orbits"]: orbs.add_orbit( *nljz )
+        self.allocate_density( ModelSpace.get_modelspace( orbits=orbs ) )
+        block = None
+        if( file_format=="nutbar" and len(header["blocks"]) > 0 ):
+            block = header["blocks"][0]
+            self.Jbra, self.wflabel_bra, self.Jket, self.wflabel_ket = block[0]/2, block[1], block[2]/2, block[3]
+        if( file_format=="kshell" ):
+            key = [ int(2*self.Jbra), self.wflabel_bra, int(2*self.Jket), self.wflabel_ket ]
+            for x in header["blocks"]:
+                if( x[:4] == key ): block = x
+        if( block is None or block[5]+block[7] == 0 ): return True
+        data = np.memmap( fn, dtype=np.uint8, mode="r", offset=16, shape=(hpos-16,) )
+        one = np.frombuffer( data, dtype=_OBTD_DTYPE, count=block[5], offset=block[4] )
+        two = np.frombuffer( data, dtype=_TBTD_DTYPE, count=block[7], offset=block[6] )
+        for a, b, jr, me in one.tolist(): self.one[(a,b,jr)] = me
+        for chbra, chket, bra, ket, jr, me in two.tolist(): self.two.setdefault( (chbra,chket), {} )[(bra,ket,jr)] = me
+        return True
+
     def _skip_comment(self,f,comment="#"):
         while True:
             x = f.tell()
@@ -168,78 +298,23 @@ class TransitionDensity:
         if(not os.path.exists(filename)):
             print("file is not found {}".format(filename))
             return
-        f = open(filename, 'r')
-        orbs = Orbits()
-        while True:
-            line = f.readline()
-            if(line[1:12] == "model space"):
-                break
-        while True:
-            entry = f.readline().split()
-            if( len(entry)==0 ): break
-            if( entry[0]=='k,'): continue
-            orbs.add_orbit( int(entry[1]), int(entry[2]), int(entry[3]), int(entry[4]) )
-        #ms = ModelSpace.ModelSpace()
-        ms = ModelSpace()
-        ms.set_modelspace_from_orbits( orbs )
-        self.allocate_density( ms )
-
-        lines = f.readlines()
-        f.close()
-
-        i = 0
-        i_obtd = 0
-        i_tbtd = 0
-        store_obtd=False
-        store_tbtd=False
-        for line in lines:
-            i += 1
-            if(not line.startswith("OBTD:")): i_obtd = 0
-            if(not line.startswith("TBTD:")): i_tbtd = 0
-            if(line.startswith("OBTD:")):
-                if(i_obtd == 0):
-                    str1 = lines[i-3]
-                    if(str1[0:4] != 'w.f.'): print("see file "+filename+" at line "+str(i))
-                    d = str1.split()
-                    j2_bra = int(d[2][:-3])
-                    j2_ket = int(d[5][:-3])
-                    i_bra = int(d[3][:-1])
-                    i_ket = int(d[6][:-1])
-                    if(j2_bra == int(2*self.Jbra) and j2_ket == int(2*self.Jket) and
-                            i_bra == self.wflabel_bra and i_ket == self.wflabel_ket): store_obtd=True
-                    if(j2_bra != int(2*self.Jbra) or j2_ket != int(2*self.Jket) or
-                            i_bra != self.wflabel_bra or i_ket != self.wflabel_ket): store_obtd=False
-                    if(not store_obtd): i_obtd = -1
-                if(store_obtd):
-                    data = line.split()
-                    a, b, jr, wf_label_bra, wf_label_ket, me = int(data[1]), int(data[2]), int(data[4]), \
-                            int(data[6]), int(data[7]), float(data[9])
-                    self.set_1btd(a,b,jr,me)
-                    i_obtd += 1
-                continue
-            if(line.startswith("TBTD")):
-                if(i_tbtd == 0):
-                    str1 = lines[i-3]
-                    if(str1[0:4] != 'w.f.'): print("see file "+filename+" at line "+str(i))
-                    d = str1.split()
-                    j2_bra = int(d[2][:-3])
-                    j2_ket = int(d[5][:-3])
-                    i_bra = int(d[3][:-1])
-                    i_ket = int(d[6][:-1])
-                    if(j2_bra == int(2*self.Jbra) and j2_ket == int(2*self.Jket) and
-                            i_bra == self.wflabel_bra and i_ket == self.wflabel_ket): store_tbtd=True
-                    if(j2_bra != int(2*self.Jbra) or j2_ket != int(2*self.Jket) or
-                            i_bra != self.wflabel_bra or i_ket != self.wflabel_ket): store_tbtd=False
-                    if(not store_tbtd): i_tbtd = -1
-                if(store_tbtd):
-                    data = line.split()
-                    a, b, c, d, Jab, Jcd, Jr, wf_label_bra, wf_label_ket, me = \
-                            int(data[1]), int(data[2]), int(data[3]), int(data[4]), \
-                            int(data[6]), int(data[7]), int(data[8]), \
-                            int(data[10]), int(data[11]), float(data[13])
-                    self.set_2btd_from_indices(a,b,c,d,Jab,Jcd,Jr,me)
-                    i_tbtd += 1
-                continue
+        index = KshellDensityIndex( filename )
+        if( index.ms is None ): return
+        self.allocate_density( index.ms )
+        key = ( int(2*self.Jbra), self.wflabel_bra, int(2*self.Jket), self.wflabel_ket )
+        with open(filename, "rb") as f:
+            for kind, offset, length in index.blocks.get( key, [] ):
+                f.seek( offset )
+                self._set_kshell_lines( kind, f.read(length).decode() )
+    def _set_kshell_lines(self, kind, text):
+        """
+        set the OBTD or TBTD lines (text) of a KSHELL density file
+        """
+        entries = [ _parse_kshell_line( kind, line ) for line in text.splitlines() ]
+        if( kind == "OBTD" ):
+            for a, b, jr, me in entries: self.set_1btd( a, b, jr, me )
+        elif( len(entries) > 0 ):
+            self.set_2btd_batch( *zip( *entries ) )
 
     def _read_td_nutbar_format(self, filename):
         f = open(filename,"r")
@@ -252,8 +327,7 @@ class TransitionDensity:
                 f.seek(x)
                 break
             orbs.add_orbit( int(entry[1]), int(entry[2]), int(entry[3]), -int(entry[4]) )
-        ms = ModelSpace.ModelSpace()
-        ms.set_modelspace_from_orbits( orbs )
+        ms = ModelSpace.get_modelspace( orbits=orbs )
         self.allocate_density( ms )
         two_body_kets = []
         self._skip_comment(f)
@@ -313,7 +387,7 @@ class TransitionDensity:
             chbra = two.get_channel(ichbra)
             for ichket in range(ichbra+1):
                 chket = two.get_channel(ichket)
-                for key in self.two[(ichbra,ichket)].keys():
+                for key in self.two.get( (ichbra,ichket), {} ).keys():
                     bra, ket, Jr = key
                     a, b = chbra.orbit1_index[bra], chbra.orbit2_index[bra]
                     c, d = chket.orbit1_index[ket], chket.orbit2_index[ket]
@@ -412,62 +486,309 @@ class TransitionDensity:
     def eval( self, op, J1=None, J2=None ):
         return self.calc_expectation_value( op, J1, J2 )
     def calc_expectation_value( self, op, J1=None, J2=None ):
+        """
+        <bra|| op ||ket> split into zero-, one-, and two-body parts as sums of op x density
+        over the one-body matrix and the two-body channel pairs
+        J1: only the (a,b) with ja==J1 or jb==J1 (doubled) in the one-body part
+        J2: only the channel pairs with Jbra==J2 or Jket==J2 in the two-body part
+        """
         orbits_de = self.ms.orbits
         orbits_op = op.ms.orbits
-        norbs = orbits_op.get_num_orbits()
+        scalar = ( op.rankJ==0 and op.rankP==1 and op.rankZ==0 )
 
         zero = op.get_0bme()
-        one = 0
-        for i in range(1, norbs+1):
-            oi = orbits_op.get_orbit(i)
-            i_d = orbits_de.get_orbit_index(oi.n, oi.l, oi.j, oi.z)
-            for j in range(1, norbs+1):
-                oj = orbits_op.get_orbit(j)
-                j_d = orbits_de.get_orbit_index(oj.n, oj.l, oj.j, oj.z)
-                if( J1!=None and oi.j!=J1 and oj.j!=J1 ): continue
-                if( abs(oi.z-oj.z) != 2*op.rankZ): continue
-                if((-1)**(oi.l+oj.l) * op.rankP != 1): continue
-                if( self._triag( oi.j, oj.j, 2*op.rankJ )): continue
-                if( op.rankJ==0 and op.rankP==1 and op.rankZ==0 ):
-                    one += op.get_1bme(i,j) * self.get_1btd(i_d,j_d,op.rankJ) * np.sqrt(oj.j+1) / np.sqrt(2*self.Jbra+1)
-                else:
-                    #print( "{:3d}{:3d}{:10.6f}{:10.6f}{:10.6f}".format(i_d,j_d,\
-                    #        op.get_1bme(i,j), self.get_1btd(i_d,j_d,op.rankJ), op.get_1bme(i,j) * self.get_1btd(i_d,j_d,op.rankJ) ))
-                    one += op.get_1bme(i,j) * self.get_1btd(i_d,j_d,op.rankJ)
-        two = 0
-        for i in range(1, norbs+1):
-            oi = orbits_op.get_orbit(i)
-            for j in range(i, norbs+1):
-                oj = orbits_op.get_orbit(j)
-                for k in range(1, norbs+1):
-                    ok = orbits_op.get_orbit(k)
-                    for l in range(k, norbs+1):
-                        ol = orbits_op.get_orbit(l)
+        mask = orbits_op.get_pair_mask( op.rankJ, op.rankP, op.rankZ )[1:,1:]
+        j = orbits_op.j[1:]
+        if( J1!=None ): mask = mask & ( (j[:,None]==J1) | (j[None,:]==J1) )
+        me = op.one * self._get_1btd_on( orbits_op, op.rankJ )
+        if( scalar ): me = me * np.sqrt(j+1)[None,:] / np.sqrt(2*self.Jbra+1)
+        one = np.sum( me[mask] )
 
-                        i_d = orbits_de.get_orbit_index(oi.n, oi.l, oi.j, oi.z)
-                        j_d = orbits_de.get_orbit_index(oj.n, oj.l, oj.j, oj.z)
-                        k_d = orbits_de.get_orbit_index(ok.n, ok.l, ok.j, ok.z)
-                        l_d = orbits_de.get_orbit_index(ol.n, ol.l, ol.j, ol.z)
-                        if((-1)**(oi.l+oj.l+ok.l+ol.l) * op.rankP != 1): continue
-                        if( abs(oi.z+oj.z-ok.z-ol.z) != 2*op.rankZ): continue
-                        for Jij in range( int(abs(oi.j-oj.j)/2), int((oi.j+oj.j)/2)+1):
-                            if(i == j and Jij%2 == 1): continue
-                            for Jkl in range( int(abs(ok.j-ol.j)/2), int((ok.j+ol.j)/2+1)):
-                                if(k == l and Jkl%2 == 1): continue
-                                if( self._triag( Jij, Jkl, op.rankJ )): continue
-                                if( J2!=None and Jij!=J2 and Jkl!=J2 ): continue
-                                if(op.rankJ==0 and op.rankP==1 and op.rankZ==0):
-                                    two += op.get_2bme_from_indices(i,j,k,l,Jij,Jkl) * self.get_2btd_from_indices(i_d,j_d,k_d,l_d,Jij,Jkl,op.rankJ) * \
-                                            np.sqrt(2*Jij+1)/np.sqrt(2*self.Jbra+1)
-                                    #print("{:3d},{:3d},{:3d},{:3d},{:3d},{:3d},{:3d},{:12.6f}".format(i_d,j_d,k_d,l_d,Jij,Jkl,op.rankJ,self.get_2btd_from_indices(i_d,j_d,k_d,l_d,Jij,Jkl,op.rankJ)))
-                                    #print("{:3d},{:3d},{:3d},{:3d},{:3d},{:3d},{:12.6f}".format(i,j,k,l,Jij,Jkl,op.get_2bme_from_indices(i,j,k,l,Jij,Jkl)))
-                                else:
-                                    two += op.get_2bme_from_indices(i,j,k,l,Jij,Jkl) * self.get_2btd_from_indices(i_d,j_d,k_d,l_d,Jij,Jkl,op.rankJ)
-                                    #print("{:3d},{:3d},{:3d},{:3d},{:3d},{:3d},{:3d},{:12.6f}".format(i_d,j_d,k_d,l_d,Jij,Jkl,op.rankJ,self.get_2btd_from_indices(i_d,j_d,k_d,l_d,Jij,Jkl,op.rankJ)))
-                                    #print("{:3d},{:3d},{:3d},{:3d},{:3d},{:3d},{:12.6f}".format(i,j,k,l,Jij,Jkl,op.get_2bme_from_indices(i,j,k,l,Jij,Jkl)))
-                                    #print("{:3d},{:3d},{:3d},{:3d},{:3d},{:3d},{:16.10f},{:16.10f}".format(i,j,k,l,Jij,Jkl,op.get_2bme_from_indices(i,j,k,l,Jij,Jkl),\
-                                    #        op.get_2bme_from_indices(i,j,k,l,Jij,Jkl) * self.get_2btd_from_indices(i_d,j_d,k_d,l_d,Jij,Jkl,op.rankJ)))
+        two = 0
+        if( self.ms.rank <= 1 or op.ms.rank <= 1 ): return zero,one,two
+        for ichbra, ichket, Jbra, Jket, td in self._get_2btd_blocks_on( op.ms, op.rankJ, op.rankP, op.rankZ ):
+            if( J2!=None and Jbra!=J2 and Jket!=J2 ): continue
+            if( (max(ichbra,ichket),min(ichbra,ichket)) not in op.two ): continue
+            me = np.vdot( op.get_2bme_full_block( ichbra, ichket ), td )
+            if( scalar ): me *= np.sqrt(2*Jbra+1)/np.sqrt(2*self.Jbra+1)
+            two += me
         return zero,one,two
+    def _get_1btd_on(self, orbits, jrank):
+        """
+        one-body density of rank jrank as a norbs x norbs matrix in the orbit order of orbits
+        """
+        key = ("one", orbits, jrank)
+        if( key not in self._dense ):
+            idx = self.ms.orbits.get_orbit_indices( orbits.n, orbits.l, orbits.j, orbits.z )
+            idx = np.maximum( idx, 0 )[1:]
+            mat = self.get_1btd_matrix( jrank )[np.ix_(idx,idx)]
+            mat.flags.writeable = False
+            self._dense[key] = mat
+        return self._dense[key]
+    def _get_2btd_blocks_on(self, ms, rankJ, rankP, rankZ):
+        """
+        non-zero two-body density blocks of rank rankJ mapped on the channels of ms
+        output: list of (chbra, chket, Jbra, Jket, block) with chbra, chket the channel indices in ms
+                (both orderings), cached like get_2btd_block
+        """
+        key = (ms, rankJ, rankP, rankZ)
+        if( key in self._dense ): return self._dense[key]
+        maps = self._get_channel_map( ms )
+        inverse = { m[0]: ich for ich, m in enumerate(maps) if m is not None }
+        channels = ms.two.channels
+        blocks = []
+        for chbra_de, chket_de in sorted( self.two.keys() ):
+            if( len(self.two[(chbra_de,chket_de)]) == 0 ): continue
+            if( chbra_de not in inverse or chket_de not in inverse ): continue
+            ichbra, ichket = inverse[chbra_de], inverse[chket_de]
+            chbra, chket = channels[ichbra], channels[ichket]
+            if( self._triag( chbra.J, chket.J, rankJ )): continue
+            if( chbra.P * chket.P * rankP != 1): continue
+            if( abs(chbra.Z-chket.Z) != rankZ): continue
+            bra, ph_bra = maps[ichbra][1:]
+            ket, ph_ket = maps[ichket][1:]
+            td = self.get_2btd_block( chbra_de, chket_de, rankJ )[np.ix_(bra,ket)] * np.outer( ph_bra, ph_ket )
+            if( not td.any() ): continue
+            td.flags.writeable = False
+            blocks.append( (ichbra, ichket, chbra.J, chket.J, td) )
+        self._dense[key] = blocks
+        return blocks
+
+def _read_kshell_orbits(f):
+    """
+    reads the model space part of a KSHELL density file (text or binary mode)
+    output: list of [n, l, j, tz], None if the model space is not found
+    """
+    while True:
+        line = f.readline()
+        if( isinstance(line, bytes) ): line = line.decode()
+        if( len(line) == 0 ): return None
+        if( line[1:12] == "model space" ): break
+    orbits = []
+    while True:
+        entry = f.readline().split()
+        if( len(entry) == 0 ): break
+        if( entry[0] in ("k,", b"k,") ): continue
+        orbits.append( [ int(entry[1]), int(entry[2]), int(entry[3]), int(entry[4]) ] )
+    return orbits
+
+def _parse_kshell_header(line):
+    """
+    "w.f. J1= 2*Jbra/2( wflabel_bra) J2= 2*Jket/2( wflabel_ket)" -> (2*Jbra, wflabel_bra, 2*Jket, wflabel_ket)
+    None if line is not a header
+    """
+    if( line[0:4] != "w.f." ): return None
+    d = line.split()
+    return ( int(d[2][:-3]), int(d[3][:-1]), int(d[5][:-3]), int(d[6][:-1]) )
+
+def _parse_kshell_line(kind, line):
+    """
+    OBTD line -> (a, b, jrank, me), TBTD line -> (a, b, c, d, Jab, Jcd, jrank, me)
+    """
+    data = line.split()
+    if( kind == "OBTD" ): return int(data[1]), int(data[2]), int(data[4]), float(data[9])
+    return int(data[1]), int(data[2]), int(data[3]), int(data[4]), \
+            int(data[6]), int(data[7]), int(data[8]), float(data[13])
+
+def get_kshell_modelspace(filename):
+    """
+    ModelSpace of a KSHELL density file, only the model space part of the file is read
+    """
+    with open(filename, "r") as f: orbits = _read_kshell_orbits( f )
+    if( orbits is None ): return None
+    orbs = Orbits()
+    for nljz in orbits: orbs.add_orbit( *nljz )
+    return ModelSpace.get_modelspace( orbits=orbs )
+
+def iter_kshell_density(filename):
+    """
+    streaming parser of a KSHELL density file, one record per block in the order of the file:
+        (Jbra, wflabel_bra, Jket, wflabel_ket, obtd, tbtd)
+        obtd: list of (a, b, jrank, me), the arguments of TransitionDensity.set_1btd
+        tbtd: list of (a, b, c, d, Jab, Jcd, jrank, me), the arguments of TransitionDensity.set_2btd_from_indices
+    The orbit indices are those of get_kshell_modelspace(filename). Only the current block is kept in memory,
+    so the iteration can be stopped at any point.
+    """
+    with open(filename, "r") as f:
+        if( _read_kshell_orbits( f ) is None ):
+            print("model space is not found in " + filename)
+            return
+        key = None
+        obtd, tbtd = [], []
+        prev = ["", ""]
+        kind = None
+        for line in f:
+            if( line.startswith("OBTD:") ): this = "OBTD"
+            elif( line.startswith("TBTD") ): this = "TBTD"
+            else: this = None
+            if( this is not None and this != kind ):
+                header = _parse_kshell_header( prev[0] )
+                if( header is None ): print("see file " + filename + " before " + line.strip())
+                if( header != key and key is not None ):
+                    yield key[0]/2, key[1], key[2]/2, key[3], obtd, tbtd
+                if( header != key ): obtd, tbtd = [], []
+                key = header
+            if( this is not None and key is not None ):
+                if( this == "OBTD" ): obtd.append( _parse_kshell_line( this, line ) )
+                else: tbtd.append( _parse_kshell_line( this, line ) )
+            kind = this
+            prev = [prev[1], line]
+        if( key is not None ): yield key[0]/2, key[1], key[2]/2, key[3], obtd, tbtd
+
+def evaluate_matrix(operators, densities, J1=None, J2=None):
+    """
+    sum(density.eval(op)) for all the operators and densities
+    The operators with the same model space and ranks are evaluated together,
+    with one matrix product for the one-body part and one per two-body channel pair.
+    J1, J2: see TransitionDensity.calc_expectation_value
+    output: zero, one, two; len(operators) x len(densities) arrays
+    """
+    zero = np.zeros( (len(operators), len(densities)) )
+    one = np.zeros( (len(operators), len(densities)) )
+    two = np.zeros( (len(operators), len(densities)) )
+    if( len(operators) == 0 or len(densities) == 0 ): return zero, one, two
+    norm = 1.0 / np.sqrt( 2*np.array( [ td.Jbra for td in densities ], dtype=float ) + 1 )
+    groups = {}
+    for i, op in enumerate(operators):
+        groups.setdefault( (op.ms, op.rankJ, op.rankP, op.rankZ), [] ).append( i )
+    for (ms, rankJ, rankP, rankZ), iops in groups.items():
+        ops = [ operators[i] for i in iops ]
+        scalar = ( rankJ==0 and rankP==1 and rankZ==0 )
+        zero[iops,:] = np.array( [ op.get_0bme() for op in ops ] )[:,None]
+
+        orbits = ms.orbits
+        j = orbits.j[1:]
+        mask = orbits.get_pair_mask( rankJ, rankP, rankZ )[1:,1:]
+        if( J1!=None ): mask = mask & ( (j[:,None]==J1) | (j[None,:]==J1) )
+        factor = np.where( mask, 1.0, 0.0 )
+        if( scalar ): factor = factor * np.sqrt(j+1)[None,:]
+        O = np.array( [ ( op.one * factor ).ravel() for op in ops ] )
+        D = np.array( [ td._get_1btd_on( orbits, rankJ ).ravel() for td in densities ] )
+        one[iops,:] = O @ D.T
+        if( scalar ): one[iops,:] *= norm[None,:]
+
+        if( ms.rank <= 1 ): continue
+        pairs = {}
+        for k, td in enumerate(densities):
+            if( td.ms.rank <= 1 ): continue
+            for ichbra, ichket, Jbra, Jket, block in td._get_2btd_blocks_on( ms, rankJ, rankP, rankZ ):
+                if( J2!=None and Jbra!=J2 and Jket!=J2 ): continue
+                pairs.setdefault( (ichbra,ichket,Jbra), [] ).append( (k, block) )
+        for (ichbra, ichket, Jbra), blocks in pairs.items():
+            key = ( max(ichbra,ichket), min(ichbra,ichket) )
+            iop = [ n for n, op in enumerate(ops) if key in op.two ]
+            if( len(iop) == 0 ): continue
+            ks = [ k for k, block in blocks ]
+            O = np.array( [ ops[n].get_2bme_full_block( ichbra, ichket ).ravel() for n in iop ] )
+            D = np.array( [ block.ravel() for k, block in blocks ] )
+            me = O @ D.T
+            if( scalar ): me *= np.sqrt(2*Jbra+1) * norm[ks][None,:]
+            two[np.ix_( [ iops[n] for n in iop ], ks )] += me
+    return zero, one, two
+
+class KshellDensityIndex:
+    """
+    byte offsets of the OBTD and TBTD blocks in a KSHELL density file,
+    keyed by (2*Jbra, wflabel_bra, 2*Jket, wflabel_ket)
+    The index is made by one scan of the file and saved next to it as filename + ".idx",
+    which is used as long as the size and mtime of the file are unchanged.
+    """
+    def __init__(self, filename, sidecar=True):
+        self.filename = filename
+        self.orbits = []
+        self.blocks = {}
+        self.ms = None
+        if( not( sidecar and self._read_sidecar() ) ):
+            self._scan()
+            if( sidecar ): self._write_sidecar()
+        if( len(self.orbits) > 0 ):
+            orbs = Orbits()
+            for nljz in self.orbits: orbs.add_orbit( *nljz )
+            self.ms = ModelSpace.get_modelspace( orbits=orbs )
+    def _stat(self):
+        st = os.stat( self.filename )
+        return st.st_size, st.st_mtime_ns
+    def _scan(self):
+        size, mtime = self._stat()
+        self.orbits = []
+        self.blocks = {}
+        with open(self.filename, "rb") as f:
+            orbits = _read_kshell_orbits( f )
+            if( orbits is None ):
+                print("model space is not found in " + self.filename)
+                return
+            self.orbits = orbits
+            offset = f.tell()
+            prev = [b"", b""]
+            kind = None
+            for line in f:
+                if( line.startswith(b"OBTD:") ): this = "OBTD"
+                elif( line.startswith(b"TBTD") ): this = "TBTD"
+                else: this = None
+                if( this != kind and kind is not None ):
+                    self._add_block( header, kind, start, offset-start )
+                if( this is not None and this != kind ):
+                    header = prev[0]
+                    start = offset
+                kind = this
+                prev = [prev[1], line]
+                offset += len(line)
+            if( kind is not None ): self._add_block( header, kind, start, offset-start )
+    def _add_block(self, header, kind, offset, length):
+        key = _parse_kshell_header( header.decode() )
+        if( key is None ):
+            print("see file " + self.filename + " at byte " + str(offset))
+            return
+        self.blocks.setdefault( key, [] ).append( (kind, offset, length) )
+    def _read_sidecar(self):
+        fn = self.filename + ".idx"
+        if( not os.path.exists(fn) ): return False
+        with open(fn, "r") as f: index = json.load(f)
+        if( [index["size"], index["mtime"]] != list(self._stat()) ): return False
+        self.orbits = index["orbits"]
+        self.blocks = {}
+        for j2bra, ibra, j2ket, iket, kind, offset, length in index["blocks"]:
+            self.blocks.setdefault( (j2bra,ibra,j2ket,iket), [] ).append( (kind, offset, length) )
+        return True
+    def _write_sidecar(self):
+        size, mtime = self._stat()
+        blocks = [ list(key) + list(block) for key, blocks in self.blocks.items() for block in blocks ]
+        fn = self.filename + ".idx"
+        try:
+            with open(fn+".tmp", "w") as f:
+                json.dump( {"size":size, "mtime":mtime, "orbits":self.orbits, "blocks":blocks}, f )
+            os.replace( fn+".tmp", fn )
+        except OSError:
+            pass
+    def get_keys(self):
+        return list( self.blocks.keys() )
+    def load(self, Jbra, wflabel_bra, Jket, wflabel_ket):
+        """
+        TransitionDensity of one (Jbra, wflabel_bra, Jket, wflabel_ket) block, read with one seek per block
+        """
+        td = TransitionDensity( Jbra=Jbra, wflabel_bra=wflabel_bra, Jket=Jket, wflabel_ket=wflabel_ket, ms=self.ms )
+        with open(self.filename, "rb") as f:
+            for kind, offset, length in self.blocks.get( (int(2*Jbra), wflabel_bra, int(2*Jket), wflabel_ket), [] ):
+                f.seek( offset )
+                td._set_kshell_lines( kind, f.read(length).decode() )
+        return td
+    def load_all(self, keys=None):
+        """
+        all the blocks in one pass over the file
+        keys: if given, only the blocks [(Jbra, wflabel_bra, Jket, wflabel_ket), ...] are read
+        output: dict (Jbra, wflabel_bra, Jket, wflabel_ket) -> TransitionDensity
+        """
+        if( keys is not None ): keys = set( (int(2*Jbra), ibra, int(2*Jket), iket) for Jbra, ibra, Jket, iket in keys )
+        blocks = sorted( (block[1], block[2], block[0], key) for key, blocks in self.blocks.items() for block in blocks \
+                if keys is None or key in keys )
+        tds = {}
+        with open(self.filename, "rb") as f:
+            for offset, length, kind, key in blocks:
+                if( key not in tds ):
+                    tds[key] = TransitionDensity( Jbra=key[0]/2, wflabel_bra=key[1], Jket=key[2]/2, wflabel_ket=key[3], ms=self.ms )
+                f.seek( offset )
+                tds[key]._set_kshell_lines( kind, f.read(length).decode() )
+        return { (td.Jbra, td.wflabel_bra, td.Jket, td.wflabel_ket): td for td in tds.values() }
 
 def main():
     file_td="transition-density-file-name"
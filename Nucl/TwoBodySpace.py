@@ -1,50 +1,114 @@
 #!/usr/bin/env python3
+import numpy as np
 if(__package__==None or __package__==""):
     import Orbits
 else:
     from . import Orbits
+def _two_body_states(orbits, e2max):
+    """
+    enumerate every orbit pair a <= b once and distribute it to all the allowed (J,P,Z)
+    output: dict (J,P,Z) -> (a, b) arrays, each in the order of itertools.combinations_with_replacement
+    """
+    e, l, j, z = orbits.e[1:], orbits.l[1:], orbits.j[1:], orbits.z[1:]
+    idx = np.arange( len(orbits.orbits) )
+    ia, ib = np.nonzero( ( idx[:,None] <= idx[None,:] ) & ( e[:,None] + e[None,:] <= e2max ) )
+    Jmin = np.abs( j[ia]-j[ib] )//2
+    n = ( j[ia]+j[ib] )//2 - Jmin + 1
+    x = np.repeat( np.arange(len(ia)), n )
+    J = Jmin[x] + np.arange(len(x)) - np.repeat( np.cumsum(n)-n, n )
+    keep = ~( (ia[x]==ib[x]) & (J%2==1) ) & ( J < e2max+2 )
+    x, J = x[keep], J[keep]
+    P = 1 - 2*( (l[ia[x]]+l[ib[x]])%2 )
+    Z = ( z[ia[x]]+z[ib[x]] )//2
+    key = J*6 + ( 1-P )//2*3 + ( Z+1 )
+    order = np.argsort( key, kind="stable" )
+    x, key = x[order], key[order]
+    bounds = np.nonzero( np.diff(key) )[0] + 1
+    states = {}
+    for s in np.split( np.arange(len(x)), bounds ):
+        if( len(s) == 0 ): continue
+        k = int( key[s[0]] )
+        states[(k//6, 1-2*((k%6)//3), k%3-1)] = ( ia[x[s]]+1, ib[x[s]]+1 )
+    return states
+
+class _PairTable:
+    """
+    read-only dict-like view (a,b) -> table[a,b] of a dense per-channel array,
+    entries with valid[a,b] == False raise KeyError like a missing dict key
+    """
+    def __init__(self, table, valid):
+        self.table = table
+        self.valid = valid
+    def __getitem__(self, key):
+        a, b = key
+        if( 0 <= a < self.valid.shape[0] and 0 <= b < self.valid.shape[1] and self.valid[a,b] ):
+            return int( self.table[a,b] )
+        raise KeyError( key )
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except (KeyError, TypeError, ValueError):
+            return False
+    def get(self, key, default=None):
+        if( key in self ): return self[key]
+        return default
+    def keys(self):
+        a, b = np.nonzero( self.valid )
+        return list( zip( a.tolist(), b.tolist() ) )
+    def items(self):
+        a, b = np.nonzero( self.valid )
+        return list( zip( zip( a.tolist(), b.tolist() ), self.table[a,b].tolist() ) )
+    def values(self):
+        return self.table[self.valid].tolist()
+    def __iter__(self):
+        return iter( self.keys() )
+    def __len__(self):
+        return int( np.count_nonzero( self.valid ) )
+
 class TwoBodyChannel:
-    def __init__(self,J=None,P=None,Z=None,orbits=None,e2max=None):
+    def __init__(self,J=None,P=None,Z=None,orbits=None,e2max=None,states=None):
+        """
+        states: (a, b) arrays of this channel, computed from orbits if not given
+        index_from_ab, phase_from_ab: dense (norbs+1) x (norbs+1) arrays, index is -1 for pairs not in the channel
+        """
         self.J = J
         self.P = P
         self.Z = Z
         self.orbits = orbits
         self.e2max = e2max
-        self.orbit1_index = []
-        self.orbit2_index = []
-        self.phase_from_indices = {}
-        self.index_from_indices = {}
+        self.orbit1_index = np.zeros(0, dtype=int)
+        self.orbit2_index = np.zeros(0, dtype=int)
+        self.index_from_ab = np.full( (1,1), -1, dtype=np.int32 )
+        self.phase_from_ab = np.zeros( (1,1), dtype=np.int8 )
         self.number_states = 0
         if( self.J != None and self.P != None and self.Z != None and orbits != None ):
-            self._set_two_body_channel()
-            return
-    def _set_two_body_channel(self):
+            self._set_two_body_channel(states)
+        self.index_from_indices = _PairTable( self.index_from_ab, self.index_from_ab >= 0 )
+        self.phase_from_indices = _PairTable( self.phase_from_ab, self.index_from_ab >= 0 )
+    def _set_two_body_channel(self, states=None):
         orbs = self.orbits
         if(self.e2max==None): self.e2max = 2*orbs.emax
-        import itertools
-        for oa, ob in itertools.combinations_with_replacement( orbs.orbits, 2 ):
-            ia = orbs.get_orbit_index_from_orbit( oa )
-            ib = orbs.get_orbit_index_from_orbit( ob )
-            if( ia == ib and self.J%2==1 ): continue
-            if( oa.e + ob.e > self.e2max ): continue
-            if( (oa.z + ob.z) != 2*self.Z ): continue
-            if( (-1)**(oa.l + ob.l) != self.P ): continue
-            if( self._triag( oa.j, ob.j, 2*self.J ) ): continue
-            self.orbit1_index.append( ia )
-            self.orbit2_index.append( ib )
-            idx = len( self.orbit1_index )-1
-            self.index_from_indices[(ia,ib)] = idx
-            self.index_from_indices[(ib,ia)] = idx
-            self.phase_from_indices[(ia,ib)] = 1
-            self.phase_from_indices[(ib,ia)] = -(-1)**( (oa.j+ob.j)//2 - self.J )
-        self.number_states = len( self.orbit1_index )
+        if( states is None ):
+            states = _two_body_states( orbs, self.e2max ).get( (self.J,self.P,self.Z), ( np.zeros(0, dtype=int), np.zeros(0, dtype=int) ) )
+        ia, ib = states
+        norbs = orbs.get_num_orbits()
+        j = orbs.j
+        self.orbit1_index, self.orbit2_index = ia, ib
+        self.number_states = len( ia )
+        self.index_from_ab = np.full( (norbs+1, norbs+1), -1, dtype=np.int32 )
+        self.phase_from_ab = np.zeros( (norbs+1, norbs+1), dtype=np.int8 )
+        self.index_from_ab[ia,ib] = np.arange( self.number_states )
+        self.index_from_ab[ib,ia] = np.arange( self.number_states )
+        self.phase_from_ab[ia,ib] = 1
+        self.phase_from_ab[ib,ia] = -(-1)**( (j[ia]+j[ib])//2 - self.J )
     def get_number_states(self):
         return self.number_states
     def get_indices(self,idx):
         return self.orbit1_index[idx], self.orbit2_index[idx]
     def get_orbits(self,idx):
         ia, ib = self.get_indices(idx)
-        return self.orbits.get_orbit[ia], self.orbits.get_orbit[ib]
+        return self.orbits.get_orbit(ia), self.orbits.get_orbit(ib)
     def get_JPZ(self):
         return self.J, self.P, self.Z
     def _triag(self,J1,J2,J3):
@@ -59,17 +123,23 @@ class TwoBodySpace:
         self.index_from_JPZ = {}
         self.channels = []
         self.number_channels = 0
+        self.channel_from_abJ = None
+        self.index_from_abJ = None
+        self.phase_from_abJ = None
+        self.JPZ_from_index = None
         if( self.orbits != None ):
             if( self.e2max == None ): self.e2max = 2*self.orbits.emax
+            states = _two_body_states( self.orbits, self.e2max )
             for J in range(self.e2max+2):
                 for P in [1,-1]:
                     for Z in [-1,0,1]:
-                        channel = TwoBodyChannel(J=J,P=P,Z=Z,orbits=self.orbits,e2max=e2max)
-                        if( channel.get_number_states() == 0): continue
+                        if( (J,P,Z) not in states ): continue
+                        channel = TwoBodyChannel(J=J,P=P,Z=Z,orbits=self.orbits,e2max=self.e2max,states=states[(J,P,Z)])
                         self.channels.append( channel )
                         idx = len(self.channels) - 1
                         self.index_from_JPZ[(J,P,Z)] = idx
             self.number_channels = len(self.channels)
+            self.set_lookup_tables()
     def get_number_channels(self):
         return self.number_channels
     def get_index(self,*JPZ):
@@ -78,6 +148,55 @@ class TwoBodySpace:
         return self.channels[idx]
     def get_channel_from_JPZ(self,*JPZ):
         return self.get_channel( self.get_index(*JPZ) )
+    def set_lookup_tables(self):
+        """
+        dense tables indexed by [a, b, J] (orbit indices start from 1)
+            channel_from_abJ: channel index (int32), -1 if (a,b,J) is not allowed
+            index_from_abJ: state index in the channel (int32), -1 if not allowed
+            phase_from_abJ: phase from the (a,b) ordering (int8), 0 if not allowed
+        """
+        norbs = self.orbits.get_num_orbits()
+        Jmax = max( [ channel.J for channel in self.channels ] + [0] )
+        self.channel_from_abJ = np.full( (norbs+1, norbs+1, Jmax+1), -1, dtype=np.int32 )
+        self.index_from_abJ = np.full( (norbs+1, norbs+1, Jmax+1), -1, dtype=np.int32 )
+        self.phase_from_abJ = np.zeros( (norbs+1, norbs+1, Jmax+1), dtype=np.int8 )
+        self.JPZ_from_index = np.array( [ channel.get_JPZ() for channel in self.channels ], dtype=int ).reshape(-1,3)
+        for ich, channel in enumerate(self.channels):
+            valid = channel.index_from_ab >= 0
+            self.channel_from_abJ[valid,channel.J] = ich
+            self.index_from_abJ[valid,channel.J] = channel.index_from_ab[valid]
+            self.phase_from_abJ[valid,channel.J] = channel.phase_from_ab[valid]
+    def get_lookup_tables(self):
+        if( self.channel_from_abJ is None ): self.set_lookup_tables()
+        return self.channel_from_abJ, self.index_from_abJ, self.phase_from_abJ
+    def lookup_from_indices(self, a, b, J):
+        """
+        vectorized (a, b, J) -> (channel index, state index, phase)
+        Forbidden combinations get channel index -1 and phase 0.
+        """
+        ch_tab, idx_tab, ph_tab = self.get_lookup_tables()
+        a = np.asarray(a, dtype=int)
+        b = np.asarray(b, dtype=int)
+        J = np.asarray(J, dtype=int)
+        norbs = ch_tab.shape[0]-1
+        ok = (a>=1) & (a<=norbs) & (b>=1) & (b<=norbs) & (J>=0) & (J<ch_tab.shape[2])
+        a = np.where(ok, a, 0)
+        b = np.where(ok, b, 0)
+        J = np.where(ok, J, 0)
+        ich = np.where(ok, ch_tab[a,b,J], -1)
+        idx = np.where(ok, idx_tab[a,b,J], -1)
+        phase = np.where(ok, ph_tab[a,b,J], 0)
+        return ich, idx, phase
+    def lookup(self, a, b, J):
+        """
+        scalar (a, b, J) -> (channel index, state index, phase), (-1, -1, 0) if not allowed
+        """
+        ch_tab = self.channel_from_abJ
+        if( ch_tab is None ): ch_tab = self.get_lookup_tables()[0]
+        n1, n2, nJ = ch_tab.shape
+        if( 0 < a < n1 and 0 < b < n2 and 0 <= J < nJ ):
+            return int(ch_tab[a,b,J]), int(self.index_from_abJ[a,b,J]), int(self.phase_from_abJ[a,b,J])
+        return -1, -1, 0
     def print_channels(self):
         print("  Two-body channels list ")
         print("  J,par,  Z, # of states")
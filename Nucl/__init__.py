@@ -4,7 +4,7 @@ zero-, one-, and two-body part
 """
 from .Orbits import Orbits, OrbitsIsospin
 from .ModelSpace import ModelSpace
-from .Operator import Operator
-from .TransitionDensity import TransitionDensity
+from .Operator import Operator, load_operators, sum_operator_files
+from .TransitionDensity import TransitionDensity, KshellDensityIndex, evaluate_matrix, iter_kshell_density, get_kshell_modelspace
 from .PeriodicTable import periodic_table
 from .kshell_scripts import kshell_scripts, transit_scripts, kshell_toolkit
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
-import os, sys, time, subprocess, re, itertools
+import os, sys, time, subprocess, re, itertools, shutil, tempfile
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 if(__package__==None or __package__==""):
     import PeriodicTable
     import Operator
     import TransitionDensity
+    from TransitionDensity import KshellDensityIndex, evaluate_matrix
 else:
     from . import PeriodicTable
     from . import Operator
     from . import TransitionDensity
+    from .TransitionDensity import KshellDensityIndex, evaluate_matrix
 
 def _i2prty(i):
     if(i == 1): return '+'
@@ -81,6 +84,74 @@ def _str_to_state_Jfloat(string):
         prty = "-"
     return (J, prty, nth)
 
+def _eval_density_file(op, filename, keys):
+    """
+    sum(density.eval(op)) for the blocks keys=[(Jbra, wflabel_bra, Jket, wflabel_ket), ...] of a KSHELL density file,
+    all the blocks are read in one pass
+    """
+    me = np.full( len(keys), float( op.get_0bme() ) )
+    if(not os.path.exists(filename)):
+        print("file is not found {}".format(filename))
+        return me
+    tds = KshellDensityIndex( filename ).load_all( keys )
+    found = []
+    for n, key in enumerate(keys):
+        if( key in tds ): found.append(n)
+        else: print("The number of non-zero transition density matrix elements is 0 better to check: "+ filename + "!! " + \
+                "Jbra=" + str(key[0]) + " (wf label:"+ str(key[1])+"), Jket="+str(key[2])+" (wf label:"+str(key[3])+")")
+    if( len(found) == 0 ): return me
+    zero, one, two = evaluate_matrix( [op], [ tds[keys[n]] for n in found ] )
+    me[found] = zero[0] + one[0] + two[0]
+    return me
+
+def _calc_2v_decay_channel(op, fn_den_l, flip_l, fn_den_r, flip_r, Jbra, i_bra, Jket, i_ket, Jinter, prty, denominators):
+    """
+    sum over the intermediate states of one Jinter: sum_i <bra||op||i><i||op||ket> / denominators[i-1]
+    output: printed table and the sum
+    """
+    inter = range(1, len(denominators)+1)
+    if(flip_l): keys_l = [ (Jinter, i_inter, Jbra, i_bra) for i_inter in inter ]
+    if(not flip_l): keys_l = [ (Jbra, i_bra, Jinter, i_inter) for i_inter in inter ]
+    if(flip_r): keys_r = [ (Jket, i_ket, Jinter, i_inter) for i_inter in inter ]
+    if(not flip_r): keys_r = [ (Jinter, i_inter, Jket, i_ket) for i_inter in inter ]
+    me_l = _eval_density_file( op, fn_den_l, keys_l )
+    me_r = _eval_density_file( op, fn_den_r, keys_r )
+    reduced_me_J = np.cumsum( me_l * me_r / denominators )
+    prt = ""
+    for i_inter in inter:
+        prt += "{:6.1f} {:s} {:6d} {:14.8f} {:14.8f} {:14.8f} {:14.8f}\n".format(Jinter, prty, i_inter, \
+                me_l[i_inter-1], me_r[i_inter-1], denominators[i_inter-1], reduced_me_J[i_inter-1])
+    if( len(reduced_me_J) == 0 ): return prt, 0.0
+    return prt, reduced_me_J[-1]
+
+def _calc_2v_decay_channel_task(args):
+    """
+    args: (op, fn_opbin, arguments of _calc_2v_decay_channel after op),
+    op is read from the binary operator file fn_opbin if it is None
+    """
+    op, fn_opbin = args[:2]
+    if( op is None ):
+        op = Operator()
+        op._read_operator_binary( fn_opbin )
+    return _calc_2v_decay_channel( op, *args[2:] )
+
+def _calc_2v_decay_density_task(args):
+    """
+    densities <bra|...|state> and <state|...|ket> of one intermediate J channel,
+    transit.exe has to be copied to the working directory beforehand
+    """
+    trs, kshl_l, kshl_inter, kshl_r, bra, state, ket, batch_cmd, run_cmd, header = args
+    trs.calc_density(kshl_l, kshl_inter, states_list=[(bra,state),], batch_cmd=batch_cmd, run_cmd=run_cmd, header=header, copy_exe=False)
+    trs.calc_density(kshl_inter, kshl_r, states_list=[(state,ket),], batch_cmd=batch_cmd, run_cmd=run_cmd, header=header, copy_exe=False)
+
+def _map_channels(func, tasks, workers=None):
+    """
+    [ func(task) for task in tasks ], done by workers processes if workers > 1,
+    the results are always in the order of tasks
+    """
+    if( workers is None or workers <= 1 or len(tasks) <= 1 ): return [ func(task) for task in tasks ]
+    with ProcessPoolExecutor( max_workers=min(workers, len(tasks)) ) as pool:
+        return list( pool.map( func, tasks ) )
 
 class kshell_scripts:
     def __init__(self, kshl_dir=None, fn_snt=None, Nucl=None, states=None, hw_truncation=None, ph_truncation=None, \
@@ -708,7 +779,11 @@ class transit_scripts:
         return fn_density, flip
 
     def calc_density(self, ksh_l, ksh_r, states_list=None, header="", batch_cmd=None, run_cmd=None, \
-            i_wfs=None, calc_SF=False, parity_mix=True):
+            i_wfs=None, calc_SF=False, parity_mix=True, copy_exe=True):
+        """
+        copy_exe: copy transit.exe to the working directory for each density, set False if it is already there
+            (needed when several processes run calc_density in the same directory)
+        """
         if(states_list==None):
             states_list = [(x,y) for x,y in itertools.product( ksh_l.states.split(","), ksh_r.states.split(",") )]
         bra_side = ksh_l
@@ -752,8 +827,9 @@ class transit_scripts:
             density_files.append(fn_density)
             fn_script = os.path.splitext(fn_density)[0] + ".sh"
             fn_input = os.path.splitext(fn_density)[0] + ".input"
-            cmd = "cp " + self.kshl_dir + "/transit.exe ./"
-            subprocess.call(cmd,shell=True)
+            if(copy_exe):
+                cmd = "cp " + self.kshl_dir + "/transit.exe ./"
+                subprocess.call(cmd,shell=True)
             prt = header + '\n'
             #prt += 'echo "start runnning ' + fn_density + ' ..."\n'
             prt += 'cat >' + fn_input + ' <<EOF\n'
@@ -982,7 +1058,7 @@ class kshell_toolkit:
             fn_snt=None, fn_op=None, Nucl=None, initial_state=None, final_state=None, Nstates_inter=300, hw_truncation=None,
             run_args={"beta_cm":0, "mode_lv_hdd":0}, op_type=-10, op_rankJ=1, op_rankP=1, op_rankZ=1, verbose=False, step="kshell",
             direction="nn->pp", mode="direct", batch_cmd=None, run_cmd=None, Q=0.0, header="", list_prty_gs_inter=[-1,1],
-            calc_only_inter=False):
+            calc_only_inter=False, workers=None):
 
         """
         This would have redundant steps, but easy to run. Do not use for a big run.
@@ -993,6 +1069,7 @@ class kshell_toolkit:
             Nucl: parent nuclide
             initial_state: spin and parity of parent nucleus: str like "0+1"
             final_state: spin and parity of daughter nucleus: str like "0+1"
+            workers: number of processes for the intermediate J channels in step="density" and step="eval"
         """
         if(_none_check(kshl_dir, 'kshl_dir')): return
         if(_none_check(fn_snt, 'fn_snt')): return
@@ -1064,9 +1141,11 @@ class kshell_toolkit:
             kshl_r = kshell_scripts(kshl_dir=kshl_dir, fn_snt=fn_snt, Nucl=Nucl, states=ket, hw_truncation=hw_truncation, run_args=run_args)
             kshl_inter = kshell_scripts(kshl_dir=kshl_dir, fn_snt=fn_snt, Nucl=Nucl_inter, states=states_list, hw_truncation=hw_truncation, run_args=run_args)
             trs = transit_scripts(kshl_dir=kshl_dir)
-            for state in states_list.split(","):
-                fn_den_l, flip_l = trs.calc_density(kshl_l, kshl_inter, batch_cmd=batch_cmd, run_cmd=run_cmd, header=header)
-                fn_den_r, flip_r = trs.calc_density(kshl_inter, kshl_r, batch_cmd=batch_cmd, run_cmd=run_cmd, header=header)
+            tasks = [ (trs, kshl_l, kshl_inter, kshl_r, bra, state, ket, batch_cmd, run_cmd, header) for state in states_list.split(",") ]
+            # copied once here, the workers must not overwrite a running transit.exe
+            cmd = "cp " + kshl_dir + "/transit.exe ./"
+            subprocess.call(cmd,shell=True)
+            _map_channels( _calc_2v_decay_density_task, tasks, workers )
 
         elif(step=="eval"):
             kshl_l = kshell_scripts(kshl_dir=kshl_dir, fn_snt=fn_snt, Nucl=Nucl_daughter, states=bra, hw_truncation=hw_truncation, run_args=run_args)
@@ -1078,6 +1157,14 @@ class kshell_toolkit:
             egs_inter = levels[0][1]
             prt = ""
             reduced_me = 0.0
+            tasks = []
+            # the workers read the operator back from a binary file instead of parsing fn_op again
+            op_task, fn_opbin, tmpdir = op, None, None
+            if( workers is not None and workers > 1 ):
+                tmpdir = tempfile.mkdtemp()
+                fn_opbin = os.path.join( tmpdir, "operator.opbin" )
+                op.write_operator_file( fn_opbin )
+                op_task = None
             for state in states_list.split(","):
                 l = (bra,state)
                 flip_l = trs.set_filenames(kshl_l, kshl_inter, states_list=[l,])
@@ -1088,18 +1175,15 @@ class kshell_toolkit:
                 Jinter, prty, n_inter = _str_to_state_Jfloat(state)
                 if(A%2==0): Jinter_str = str(int(Jinter))
                 if(A%2==1): Jinter_str = "{:d}/2".format(int(2*Jinter))
-                reduced_me_J = 0.0
-                for i_inter in range(1, n_inter+1):
-                    if(flip_l): Density_L = TransitionDensity(filename=fn_den_l, Jbra=Jinter, wflabel_bra=i_inter, Jket=Jbra, wflabel_ket=i_bra)
-                    if(flip_r): Density_R = TransitionDensity(filename=fn_den_r, Jbra=Jket, wflabel_bra=i_ket, Jket=Jinter, wflabel_ket=i_inter)
-                    if(not flip_l): Density_L = TransitionDensity(filename=fn_den_l, Jbra=Jbra, wflabel_bra=i_bra, Jket=Jinter, wflabel_ket=i_inter)
-                    if(not flip_r): Density_R = TransitionDensity(filename=fn_den_r, Jbra=Jinter, wflabel_bra=i_inter, Jket=Jket, wflabel_ket=i_ket)
-                    me_l = sum(Density_L.eval(op))
-                    me_r = sum(Density_R.eval(op))
-                    me = me_l * me_r
-                    en_inter = edict_inter[(Jinter_str,prty,i_inter)]
-                    reduced_me_J += me / ( en_inter-egs_inter + Q)
-                    prt += "{:6.1f} {:s} {:6d} {:14.8f} {:14.8f} {:14.8f} {:14.8f}\n".format(Jinter, prty, i_inter, me_l, me_r, en_inter-egs_inter+Q, reduced_me_J)
+                en_inter = np.array( [ edict_inter[(Jinter_str,prty,i_inter)] for i_inter in range(1, n_inter+1) ] )
+                tasks.append( (op_task, fn_opbin, fn_den_l, flip_l, fn_den_r, flip_r, \
+                        Jbra, i_bra, Jket, i_ket, Jinter, prty, en_inter-egs_inter+Q) )
+            try:
+                results = _map_channels( _calc_2v_decay_channel_task, tasks, workers )
+            finally:
+                if( tmpdir is not None ): shutil.rmtree( tmpdir, ignore_errors=True )
+            for prt_J, reduced_me_J in results:
+                prt += prt_J
                 """
                 TODO: following summation is not correct
                 """